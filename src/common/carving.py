@@ -35,19 +35,62 @@ class VoxelAccumulator(object):
             c) The depth to each voxel that projects inside the image
         '''
 
-        # Projecting voxels into image
-        xyz = self.voxel_grid.world_meshgrid()
-        projected_voxels = im.cam.project_points(xyz)
+        inside_image = []
+        all_uv = []
+        all_depths = []
+
+        # Projecting voxels into image, a chunk of the grid at a time
+        for _, xyz in self.voxel_grid.world_meshgrid_chunks():
+            projected_voxels = im.cam.project_points(xyz)
+
+            # seeing which are inside the image or not
+            uv = np.round(projected_voxels[:, :2]).astype(int)
+            inside = np.logical_and.reduce((uv[:, 0] >= 0,
+                                            uv[:, 1] >= 0,
+                                            uv[:, 1] < im.depth.shape[0],
+                                            uv[:, 0] < im.depth.shape[1]))
+            inside_image.append(inside)
+            all_uv.append(uv[inside, :])
+            all_depths.append(projected_voxels[inside, 2])
+
+        return (np.hstack(inside_image), np.vstack(all_uv),
+                np.hstack(all_depths))
+
+    def voxels_inside_image(self, im, pyramid_level=3, chunk_size=1000000,
+            skip_blocks=None):
+        '''
+        returns the binary array of which voxels project into the image, as
+        the first output of project_voxels. Blocks of 2**pyramid_level voxels
+        a side which are wholly inside or outside the image are found from
+        their corners alone (see voxel_data.GridPyramid.frustum_blocks), so
+        only the voxels of blocks on the edges of the image are projected.
+        skip_blocks is an optional boolean array of the blocks (of the
+        pyramid level) which the caller doesn't need; their voxels are not
+        tested, and are returned as False
+        '''
+        pyramid = voxel_data.GridPyramid(self.voxel_grid, pyramid_level)
+        inside_blocks, outside_blocks = pyramid.frustum_blocks(
+            pyramid_level, im.cam.project_points, im.depth.shape)
+
+        if skip_blocks is not None:
+            inside_blocks = np.logical_and(inside_blocks, ~skip_blocks)
+            outside_blocks = np.logical_or(outside_blocks, skip_blocks)
 
-        # seeing which are inside the image or not
-        uv = np.round(projected_voxels[:, :2]).astype(int)
-        inside_image = np.logical_and.reduce((uv[:, 0] >= 0,
-                                              uv[:, 1] >= 0,
-                                              uv[:, 1] < im.depth.shape[0],
-                                              uv[:, 0] < im.depth.shape[1]))
-        uv = uv[inside_image, :]
-        depths = projected_voxels[inside_image, 2]
-        return (inside_image, uv, depths)
+        inside_image = pyramid.expand(pyramid_level, inside_blocks).flatten()
+        to_project = np.flatnonzero(pyramid.expand(
+            pyramid_level, ~np.logical_or(inside_blocks, outside_blocks)))
+
+        for start in range(0, to_project.shape[0], chunk_size):
+            idxs = to_project[start:start + chunk_size]
+            xyz = self.voxel_grid.linear_idx_to_world(idxs)
+            uv = np.round(im.cam.project_points(xyz)[:, :2]).astype(int)
+            inside_image[idxs] = np.logical_and.reduce((
+                uv[:, 0] >= 0,
+                uv[:, 1] >= 0,
+                uv[:, 1] < im.depth.shape[0],
+                uv[:, 0] < im.depth.shape[1]))
+
+        return inside_image
 
 
 class Carver(VoxelAccumulator):
@@ -99,6 +142,8 @@ class KinfuAccumulator(voxel_data.WorldVoxels):
     valid_voxels are voxels which have been observed as empty or lie in the
     narrow band around the surface.
     '''
+    grid_names = ('V', 'weights', 'tsdf', 'valid_voxels')
+
     def __init__(self, gridsize, dtype=np.float16):
         self.gridsize = gridsize
         self.weights = np.zeros(gridsize, dtype=dtype)
@@ -294,8 +339,7 @@ class Fusion(VoxelAccumulator):
         self.accum.origin = self.voxel_grid.origin
 
         # another grid to store which voxels are visible, i.e on the surface
-        self.visible_voxels = self.voxel_grid.blank_copy()
-        self.visible_voxels.V = self.visible_voxels.V.astype(bool)
+        self.visible_voxels = self.voxel_grid.blank_copy(dtype=bool)
 
     def fuse(self, mu, filtering=False, measure_in_frustrum=False,
             inlier_threshold=np.sqrt(2)):
@@ -315,8 +359,7 @@ class Fusion(VoxelAccumulator):
         # finally a third grid, which stores how many frustrums each voxel has
         # fallen into
         if measure_in_frustrum:
-            self.in_frustrum = self.voxel_grid.blank_copy()
-            self.in_frustrum.V = self.in_frustrum.V.astype(np.int16)
+            self.in_frustrum = self.voxel_grid.blank_copy(dtype=np.int16)
 
         for count, im in enumerate(self.video.frames):
             self.integrate_image(im, mu, filtering=filtering,
@@ -0,0 +1,263 @@
+'''
+A chunked, compressed file format for voxel grids.
+The grid is split into cubic chunks (32^3 by default), each of which is
+compressed separately, so any chunk can be read without reading the rest of
+the file, and chunks can be decoded in parallel.
+Chunks holding a single value (e.g. all +mu, all -mu or all nan, which is
+most of a tsdf) are not stored at all, just their value.
+
+File layout:
+    magic               8 bytes, 'VOXCHNK1'
+    header length       uint64
+    header              json, with the grid shape, dtype, chunk shape,
+                        compression, R, origin and vox_size
+    index               uint64 (num chunks x 2), the offset and length of
+                        each chunk's bytes, relative to the start of the data.
+                        A length of 0 marks a constant chunk
+    constants           float64 (num chunks), the value of each constant chunk
+    data                the compressed chunks, in C order of chunk position
+'''
+import json
+import zlib
+import itertools
+import multiprocessing
+import numpy as np
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+MAGIC = 'VOXCHNK1'
+
+
+def available_compressions():
+    compressions = [None, 'zlib']
+    if lz4 is not None:
+        compressions.append('lz4')
+    return compressions
+
+
+def _compress(data, compression):
+    if compression is None:
+        return data
+    elif compression == 'zlib':
+        return zlib.compress(data, 6)
+    elif compression == 'lz4':
+        return lz4.frame.compress(data)
+    else:
+        raise Exception("Unknown compression " + str(compression))
+
+
+def _decompress(data, compression):
+    if compression is None:
+        return data
+    elif compression == 'zlib':
+        return zlib.decompress(data)
+    elif compression == 'lz4':
+        if lz4 is None:
+            raise Exception("This file needs the lz4 module to be read")
+        return lz4.frame.decompress(data)
+    else:
+        raise Exception("Unknown compression " + str(compression))
+
+
+def _constant_value(chunk):
+    '''
+    returns the single value in chunk, or None if there is more than one.
+    (all nan counts as a single value)
+    '''
+    first = chunk.flat[0]
+    if first != first:
+        if np.isnan(chunk).all():
+            return np.nan
+    elif (chunk == first).all():
+        return float(first)
+    return None
+
+
+def save_chunked(savepath, V, R, origin, vox_size, chunk_size=32,
+        compression='zlib'):
+    '''
+    Saves the grid V, and the transform of the grid, to savepath.
+    By default lz4 is not used even if it is available, so the files can be
+    read on machines without it
+    '''
+    if compression not in available_compressions():
+        raise Exception("Compression %s is not available" % str(compression))
+
+    chunk_shape = (chunk_size,) * 3
+    num_chunks = _num_chunks(V.shape, chunk_shape)
+
+    index = np.zeros((np.prod(num_chunks), 2), np.uint64)
+    constants = np.zeros(np.prod(num_chunks), np.float64)
+    data = []
+    offset = 0
+    for count, chunk_ijk in enumerate(np.ndindex(*num_chunks)):
+        chunk = V[_chunk_slices(chunk_ijk, chunk_shape, V.shape)]
+        value = _constant_value(chunk)
+        if value is not None:
+            constants[count] = value
+            index[count] = (offset, 0)
+        else:
+            chunk_bytes = _compress(
+                np.ascontiguousarray(chunk).tobytes(), compression)
+            index[count] = (offset, len(chunk_bytes))
+            data.append(chunk_bytes)
+            offset += len(chunk_bytes)
+
+    header = json.dumps({
+        'shape': list(V.shape),
+        'dtype': V.dtype.str,
+        'chunk_shape': list(chunk_shape),
+        'compression': compression,
+        'R': np.asarray(R, np.float64).tolist(),
+        'origin': np.asarray(origin, np.float64).tolist(),
+        'vox_size': float(vox_size)})
+
+    with open(savepath, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([len(header)], np.uint64).tobytes())
+        f.write(header)
+        f.write(index.tobytes())
+        f.write(constants.tobytes())
+        for chunk_bytes in data:
+            f.write(chunk_bytes)
+
+
+def _num_chunks(shape, chunk_shape):
+    return tuple(int(np.ceil(float(s) / c)) for s, c in zip(shape, chunk_shape))
+
+
+def _chunk_slices(chunk_ijk, chunk_shape, shape):
+    return tuple(slice(ijk * c, min((ijk + 1) * c, s))
+                 for ijk, c, s in zip(chunk_ijk, chunk_shape, shape))
+
+
+class ChunkedGridReader(object):
+    '''
+    Reads the header and chunk index of a chunked grid file, after which
+    single chunks, regions or the whole grid can be read
+    '''
+
+    def __init__(self, loadpath):
+        self.loadpath = loadpath
+
+        with open(loadpath, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception("%s is not a chunked grid file" % loadpath)
+            header_length = int(np.fromfile(f, np.uint64, 1)[0])
+            header = json.loads(f.read(header_length))
+
+            self.shape = tuple(header['shape'])
+            self.dtype = np.dtype(header['dtype'])
+            self.chunk_shape = tuple(header['chunk_shape'])
+            self.compression = header['compression']
+            self.R = np.array(header['R'])
+            self.origin = np.array(header['origin'])
+            self.vox_size = header['vox_size']
+
+            self.num_chunks = _num_chunks(self.shape, self.chunk_shape)
+            total_chunks = int(np.prod(self.num_chunks))
+            self.index = np.fromfile(f, np.uint64, total_chunks * 2).reshape(
+                (total_chunks, 2))
+            self.constants = np.fromfile(f, np.float64, total_chunks)
+            self.data_start = f.tell()
+
+    def _chunk_number(self, chunk_ijk):
+        return np.ravel_multi_index(chunk_ijk, self.num_chunks)
+
+    def chunk_slices(self, chunk_ijk):
+        '''
+        The region of the full grid covered by the chunk at chunk_ijk
+        '''
+        return _chunk_slices(chunk_ijk, self.chunk_shape, self.shape)
+
+    def read_chunk(self, chunk_ijk, f=None):
+        '''
+        Reads and decodes just the one chunk. f can be the file, already
+        open, to save opening it for each chunk
+        '''
+        chunk_shape = tuple(sl.stop - sl.start
+                            for sl in self.chunk_slices(chunk_ijk))
+        offset, length = self.index[self._chunk_number(chunk_ijk)]
+
+        if length == 0:
+            return np.full(chunk_shape,
+                self.constants[self._chunk_number(chunk_ijk)], self.dtype)
+
+        if f is None:
+            with open(self.loadpath, 'rb') as f:
+                return self.read_chunk(chunk_ijk, f)
+
+        f.seek(self.data_start + int(offset))
+        chunk_bytes = _decompress(f.read(int(length)), self.compression)
+        return np.frombuffer(chunk_bytes, self.dtype).reshape(chunk_shape)
+
+    def _chunks_in_region(self, start, end):
+        first = [s // c for s, c in zip(start, self.chunk_shape)]
+        last = [(e - 1) // c for e, c in zip(end, self.chunk_shape)]
+        return list(itertools.product(
+            *[range(f, l + 1) for f, l in zip(first, last)]))
+
+    def read_region(self, start=None, end=None, processes=1):
+        '''
+        Reads the grid from voxel start (inclusive) to end (exclusive),
+        reading only the chunks which overlap this region.
+        With processes > 1 the chunks are decoded in a pool of processes
+        '''
+        start = np.zeros(3, int) if start is None else np.asarray(start)
+        end = np.array(self.shape) if end is None else np.asarray(end)
+        if np.any(start < 0) or np.any(end > self.shape) or np.any(end <= start):
+            raise Exception("Region is outside of the grid")
+
+        chunk_ijks = self._chunks_in_region(start, end)
+
+        if processes > 1 and len(chunk_ijks) > 1:
+            # each process is given a contiguous run of chunks to decode
+            runs = np.array_split(np.arange(len(chunk_ijks)), processes)
+            pool = multiprocessing.Pool(processes=processes,
+                initializer=_init_decode_worker, initargs=(self,))
+            decoded = pool.map(decode_chunks_helper,
+                [[chunk_ijks[idx] for idx in run] for run in runs])
+            pool.close()
+            pool.join()
+            chunks = list(itertools.chain(*decoded))
+        else:
+            with open(self.loadpath, 'rb') as f:
+                chunks = [self.read_chunk(chunk_ijk, f)
+                          for chunk_ijk in chunk_ijks]
+
+        V = np.empty(tuple(end - start), self.dtype)
+        for chunk_ijk, chunk in zip(chunk_ijks, chunks):
+            chunk_start = np.array(
+                [sl.start for sl in self.chunk_slices(chunk_ijk)])
+            # the overlap of this chunk with the region
+            lo = np.maximum(chunk_start, start)
+            hi = np.minimum(chunk_start + chunk.shape, end)
+            V[tuple(slice(l, h) for l, h in zip(lo - start, hi - start))] = \
+                chunk[tuple(slice(l, h) for l, h in
+                            zip(lo - chunk_start, hi - chunk_start))]
+        return V
+
+    def compression_ratio(self):
+        '''
+        How many times smaller the chunks are on disk than in memory
+        '''
+        stored = float(self.index[:, 1].sum())
+        return np.prod(self.shape) * self.dtype.itemsize / max(stored, 1)
+
+
+def decode_chunks_helper(chunk_ijks):
+    with open(reader.loadpath, 'rb') as f:
+        return [reader.read_chunk(chunk_ijk, f) for chunk_ijk in chunk_ijks]
+
+
+def _init_decode_worker(reader_in):
+    '''
+    Each pool process calls this initializer. Here we load the reader
+    (just the header and chunk index) into that process's global namespace
+    '''
+    global reader
+    reader = reader_in
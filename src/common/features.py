@@ -188,55 +188,76 @@ class SampledFeatures(object):
     '''
     Samples values from a voxel grid about a point and a normal
     '''
-    def __init__(self, num_rings, radius):
+    def __init__(self, num_rings, radius, interpolation='nearest'):
         '''
         units are in real world space I think...
+        interpolation is how the grid is sampled, 'nearest' or 'trilinear'
         '''
         self.num_rings = num_rings
         self.radius = radius
+        self.interpolation = interpolation
 
     def set_scene(self, sc):
         self.sc = sc
 
-    def _get_sample_locations(self, point, normal):
+    def _get_sample_locations(self, points, normals):
         '''
-        returns a Nx3 array of the *world* locations of where to sample from
+        returns a NxLx3 array of the *world* locations of where to sample from,
+        for each of the N points and normals given
         assumes the grid to be orientated correctly with the up direction
         pointing upwards
         '''
-        # print "norm is ", normal
-        # print "angle is ", start_angle
-        start_angle = np.rad2deg(np.arctan2(normal[0], normal[1]))
+        start_angles = np.rad2deg(np.arctan2(normals[:, 0], normals[:, 1]))
         ring_offsets = self.radius * (1 + np.arange(self.num_rings))
 
-        # now combining...
-        all_locations = []
-        for r in ring_offsets:
-            for elevation in np.deg2rad(np.array([-45, 0, 45])):
-                z = r * np.sin(elevation)
-                cos_elevation = np.cos(elevation)
-                for azimuth in np.deg2rad(start_angle + np.arange(0, 360, 45)):
-                    x = r * np.sin(azimuth) * cos_elevation
-                    y = r * np.cos(azimuth) * cos_elevation
-                    all_locations.append([x, y, z])
+        # dimensions are (point, ring, elevation, azimuth)
+        r = ring_offsets[None, :, None, None]
+        elevation = np.deg2rad(np.array([-45, 0, 45]))[None, None, :, None]
+        azimuth = np.deg2rad(
+            start_angles[:, None] + np.arange(0, 360, 45))[:, None, None, :]
+
+        z = r * np.sin(elevation)
+        cos_elevation = np.cos(elevation)
+        x = r * np.sin(azimuth) * cos_elevation
+        y = r * np.cos(azimuth) * cos_elevation
+
+        ring_locations = np.stack(
+            np.broadcast_arrays(x, y, z), axis=4).reshape(points.shape[0], -1, 3)
 
         # add top and bottom locations
-        for ring_radius in ring_offsets:
-            all_locations.append([0, 0, ring_radius])
-            all_locations.append([0, 0, -ring_radius])
+        top_and_bottom = np.zeros((self.num_rings, 2, 3))
+        top_and_bottom[:, 0, 2] = ring_offsets
+        top_and_bottom[:, 1, 2] = -ring_offsets
+        top_and_bottom = np.tile(
+            top_and_bottom.reshape(1, -1, 3), (points.shape[0], 1, 1))
 
-        locations = np.array(all_locations)
+        locations = np.concatenate((ring_locations, top_and_bottom), axis=1)
 
         # finally add on the start location...
-        return locations + point
+        return locations + points[:, None, :]
+
+    def _sample(self, points, normals):
+        # sampled feature for each of the N points, in one pass through the grid
+        world_sample_locations = self._get_sample_locations(points, normals)
+        world_sample_locations = world_sample_locations.reshape(-1, 3)
+
+        if self.interpolation == 'nearest':
+            idxs = self.sc.im_tsdf.world_to_idx(world_sample_locations)
+            sampled_values = self.sc.im_tsdf.get_idxs(idxs, check_bounds=True)
+        elif self.interpolation == 'trilinear':
+            # locations outside of the grid are nan, as for nearest
+            sampled_values = np.zeros(world_sample_locations.shape[0]) * np.nan
+            valid_values, valid, _ = self.sc.im_tsdf.just_valid_world_to_idx(
+                world_sample_locations, interpolation='trilinear')
+            sampled_values[valid] = valid_values
+        else:
+            raise Exception("Unknown interpolation %s" % self.interpolation)
+
+        return sampled_values.reshape(points.shape[0], -1)
 
     def _single_sample(self, point, normal):
         # sampled feature for a single point
-        world_sample_location = self._get_sample_locations(point, normal)
-        idxs = self.sc.im_tsdf.world_to_idx(world_sample_location)
-        sampled_values = self.sc.im_tsdf.get_idxs(idxs, check_bounds=True)
-
-        return sampled_values
+        return self._sample(point[None, :], normal[None, :])[0]
 
     def sample_idx(self, idx):
         # samples at each of the N locations, and returns some shape thing
@@ -253,5 +274,4 @@ class SampledFeatures(object):
 
         xyz = self.sc.im.get_world_xyz()
         norms = self.sc.im.get_world_normals()
-        return np.vstack(
-            [self._single_sample(xyz[idx], norms[idx]) for idx in point_idxs])
+        return self._sample(xyz[point_idxs], norms[point_idxs])
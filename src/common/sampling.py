@@ -0,0 +1,102 @@
+'''
+The distribution over the pixels of an image from which voxlet locations
+are sampled
+'''
+import numpy as np
+import scipy.io
+
+
+class PointSampler(object):
+    '''
+    Computes the sampling distribution over an image just once, after which
+    each draw of N points is a binary search of the cumulative distribution
+    (so O(N log P) rather than O(P) for an image of P pixels)
+    '''
+
+    def __init__(self, im, gt_im_label=None, nyu=False, additional_mask=None,
+            sample_grid_size=None):
+        '''
+        The probability of sampling each pixel is proportional to its depth.
+        Pixels outside the mask (or outside additional_mask, if given), or
+        with upward facing normals, are never sampled. Unless nyu is true,
+        neither are pixels near the floor, pixels with a nan in gt_im_label or
+        pixels facing away from the camera.
+        Copies of the inputs are kept, so matches() can tell if the sampler
+        is out of date
+        '''
+        self.im = im
+        self.nyu = nyu
+        self.shape = im.depth.shape
+        self.mask = np.copy(im.mask)
+        self.gt_im_label = None if gt_im_label is None else np.copy(gt_im_label)
+        self.additional_mask = \
+            None if additional_mask is None else np.copy(additional_mask)
+        self.sample_grid_size = sample_grid_size
+
+        # all the reasons for not sampling at a pixel, combined in one pass
+        valid = im.mask.flatten() != 0
+        if additional_mask is not None:
+            valid &= np.asarray(additional_mask).flatten() != 0
+
+        # normals approximately pointing upwards
+        valid &= ~(im.get_world_normals()[:, 2] > 0.98)
+
+        if not nyu:
+            valid &= ~(im.get_world_xyz()[:, 2] < 0.035)
+            valid &= ~np.isnan(gt_im_label).flatten()
+            valid &= ~(im.normals[:, 2] > -0.1)
+
+        depth = im.depth.flatten()
+        self.sample_rate = np.where(valid, depth, depth.dtype.type(0))
+
+        if self.sample_rate.sum() == 0:
+            raise Exception("Sample rate is zero sum, cannot sample any points")
+
+        self.probabilities = self.sample_rate.astype(np.float64)
+        self.probabilities /= self.probabilities.sum().astype(np.float64)
+
+        # the same cumulative distribution np.random.choice would build
+        self.cdf = self.probabilities.cumsum()
+        self.cdf /= self.cdf[-1]
+
+    def matches(self, im, gt_im_label=None, nyu=False, additional_mask=None,
+            sample_grid_size=None):
+        '''
+        True if a sampler made from these inputs would be the same as this one
+        '''
+        return im is self.im and nyu == self.nyu and \
+            sample_grid_size == self.sample_grid_size and \
+            np.array_equal(im.mask, self.mask) and \
+            _same_array(gt_im_label, self.gt_im_label) and \
+            _same_array(additional_mask, self.additional_mask)
+
+    def draw(self, num_to_sample):
+        '''
+        Draws num_to_sample linear pixel indices, with replacement.
+        Gives the same draws as np.random.choice with p=self.probabilities
+        '''
+        uniform_samples = np.random.random_sample(num_to_sample)
+        return self.cdf.searchsorted(uniform_samples, side='right')
+
+    def save_debug(self, savepath):
+        '''
+        saves the sample rate image to a .mat file, for debugging
+        '''
+        scipy.io.savemat(savepath, {'sr': self.sample_rate.reshape(self.shape)})
+
+
+def _same_array(A, B):
+    '''
+    True if A and B are both None, or are arrays of equal shape and values
+    (with nans in the same places counted as equal)
+    '''
+    if A is None or B is None:
+        return A is None and B is None
+    A = np.asarray(A)
+    B = np.asarray(B)
+    if A.shape != B.shape:
+        return False
+    same = A == B
+    if A.dtype.kind == 'f':
+        same |= np.isnan(A) & np.isnan(B)
+    return bool(same.all())
@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 import subprocess as sp
 from copy import deepcopy, copy
 import time
+import heapq
 
 # IO
 import cPickle as pickle
@@ -32,6 +33,7 @@ import features
 import carving
 import mesh
 import camera
+import sampling
 
 
 class Scene(object):
@@ -77,36 +79,143 @@ class Scene(object):
 
         return frames
 
-    def sample_points(self, num_to_sample, sample_grid_size=None, additional_mask=None, nyu=False):
+    def sample_points(self, num_to_sample, sample_grid_size=None, additional_mask=None, nyu=False,
+            method='random', voxlet_params=None, num_candidates=2000,
+            debug_savepath=None, model_probabilities=None):
         '''
         Sampling locations at which to extract/place voxlets
-        '''
-        sample_rate = copy(self.im.depth)
-
-        shape = self.im.depth.shape
-        if not nyu:
-            sample_rate[self.im.get_world_xyz()[:, 2].reshape(shape) < 0.035] = 0
-            sample_rate[np.isnan(self.gt_im_label)] = 0
-            sample_rate[self.im.normals[:, 2].reshape(shape) > -0.1] = 0
-
-        # import pdb; pdb.set_trace()
-        sample_rate[self.im.mask==0] = 0
 
-        # normals approximately pointing upwards
-        sample_rate[self.im.get_world_normals()[:, 2].reshape(shape) > 0.98] = 0
-
-        if sample_rate.sum() == 0:
-            raise Exception("Sample rate is zero sum, cannot sample any points")
-
-        scipy.io.savemat('/tmp/samples.mat', {'sr':sample_rate})
-        sample_rate = sample_rate.astype(np.float64)
-        sample_rate /= sample_rate.sum().astype(np.float64)
+        method
+            'random' draws each point independently, with a probability which
+            increases with depth.
+            'coverage' chooses points so that their voxlets cover the
+            unobserved part of the scene with as few voxlets as possible.
+            This uses the voxlet shape in voxlet_params (defaulting to
+            self.voxlet_params), and can return fewer than num_to_sample points
+            if everything is covered before then.
+            voxlet_params can also be a list, one for each model. Each
+            candidate point is then given one of the models at random (with
+            model_probabilities), and its coverage is worked out with that
+            model's voxlet. The model chosen for each sample is stored in
+            self.sampled_model_choices, which Reconstructer uses in place of
+            choosing the models itself. Otherwise this is None.
+
+        additional_mask
+            if given, only the pixels where it is non-zero are sampled
+
+        debug_savepath
+            if given, the sample rate image is saved to this .mat file
+        '''
+        # the sampling distribution is only recomputed when its inputs change
+        sampler_inputs = dict(im=self.im,
+            gt_im_label=getattr(self, 'gt_im_label', None), nyu=nyu,
+            additional_mask=additional_mask, sample_grid_size=sample_grid_size)
+        if not hasattr(self, 'point_sampler') or \
+                not self.point_sampler.matches(**sampler_inputs):
+            self.point_sampler = sampling.PointSampler(**sampler_inputs)
+
+        if debug_savepath is not None:
+            self.point_sampler.save_debug(debug_savepath)
+
+        self.sampled_model_choices = None
+
+        if method == 'random':
+            samples = self.point_sampler.draw(num_to_sample)
+        elif method == 'coverage':
+            if voxlet_params is None:
+                voxlet_params = self.voxlet_params
+            if isinstance(voxlet_params, dict):
+                samples, _ = self._coverage_samples(num_to_sample,
+                    self.point_sampler.probabilities, [voxlet_params], None,
+                    num_candidates)
+            else:
+                samples, self.sampled_model_choices = self._coverage_samples(
+                    num_to_sample, self.point_sampler.probabilities,
+                    voxlet_params, model_probabilities, num_candidates)
+        else:
+            raise Exception("Unknown sampling method %s" % method)
 
-        samples = np.random.choice(shape[0]*shape[1], num_to_sample, p=sample_rate.flatten())
-        self.sampled_idxs = np.array(np.unravel_index(samples, shape)).T
+        self.sampled_idxs = np.array(
+            np.unravel_index(samples, self.point_sampler.shape)).T
 
         return self.sampled_idxs
 
+    def _coverage_samples(self, num_to_sample, sample_rate, voxlet_params,
+            model_probabilities, num_candidates):
+        '''
+        Greedy set cover of the unobserved voxels in the camera frustum.
+        Candidate points are drawn from sample_rate, and each is given one of
+        the voxlet_params at random, with model_probabilities. Then at each
+        step the candidate whose voxlet covers the most not-yet-covered
+        unobserved voxels is chosen. Voxlets are upright, so each covers the
+        slices between its bottom and top in the columns under its base.
+        As a voxlet can only cover less once others are chosen, the gains
+        are only recomputed for the best candidate each step ('lazy' greedy).
+        Returns the linear image indices of the chosen points, and the
+        index of the voxlet_params used for each
+        '''
+        num_candidates = min(num_candidates, (sample_rate > 0).sum())
+        candidates = np.random.choice(
+            sample_rate.shape[0], num_candidates, replace=False, p=sample_rate)
+        if len(voxlet_params) == 1:
+            candidate_models = np.zeros(num_candidates, dtype=int)
+        else:
+            candidate_models = np.random.choice(
+                len(voxlet_params), num_candidates, p=model_probabilities)
+
+        # the unobserved space, which is removed as it is covered
+        uncovered = np.logical_and(np.isnan(self.im_tsdf.V),
+            self.get_visible_frustrum().reshape(self.im_tsdf.V.shape))
+
+        # which columns, and which run of slices, each candidate voxlet covers
+        columns = [None] * num_candidates
+        k_start = np.zeros(num_candidates, dtype=int)
+        k_end = np.zeros(num_candidates, dtype=int)
+        for model_idx, params in enumerate(voxlet_params):
+            these = np.where(candidate_models == model_idx)[0]
+            if these.shape[0] == 0:
+                continue
+
+            voxlets = voxel_data.ShoeBoxBatch.from_voxlet_params(
+                self.im.get_world_xyz()[candidates[these]],
+                self.im.get_world_normals()[candidates[these]], params)
+            column_ij, valid = voxlets.footprint_in_grid(self.im_tsdf)
+            in_voxlet = voxlets.slices_in_grid(self.im_tsdf)
+            k_start[these] = in_voxlet.argmax(axis=1)
+            k_end[these] = k_start[these] + in_voxlet.sum(axis=1)
+
+            for count, candidate in enumerate(these):
+                columns[candidate] = np.unique(np.ravel_multi_index(
+                    (column_ij[count, valid[count], 0],
+                     column_ij[count, valid[count], 1]),
+                    self.im_tsdf.V.shape[:2]))
+
+        def gain(candidate):
+            ci, cj = np.unravel_index(columns[candidate], uncovered.shape[:2])
+            return uncovered[ci, cj, k_start[candidate]:k_end[candidate]].sum()
+
+        # the gains can only go down, so stale gains are upper bounds
+        heap = [(-gain(candidate), candidate)
+                for candidate in range(num_candidates)]
+        heapq.heapify(heap)
+
+        chosen = []
+        while len(chosen) < num_to_sample and heap:
+            _, best = heapq.heappop(heap)
+            best_gain = gain(best)
+            if best_gain <= 0:
+                continue
+            if heap and best_gain < -heap[0][0]:
+                heapq.heappush(heap, (-best_gain, best))
+                continue
+
+            chosen.append(best)
+            ci, cj = np.unravel_index(columns[best], uncovered.shape[:2])
+            uncovered[ci, cj, k_start[best]:k_end[best]] = False
+
+        chosen = np.array(chosen, dtype=int)
+        return candidates[chosen], candidate_models[chosen]
+
     def _apply_normalised_homo_transform(self, xyz, trans):
         '''
         applies homogeneous transform, and also does the normalising...
@@ -125,19 +234,41 @@ class Scene(object):
 
     def load_sequence(self, sequence, frame_nos, segment_with_gt, segment=True,
             save_grids=False, voxel_normals=False, carve=True, segment_base=None,
-            original_nyu=False):
+            original_nyu=False, mmap_gt=False, load_gt=True,
+            gt_cache_dir=None):
         '''
         loads a sequence of images, the associated gt voxel grid,
         carves the visible tsdf from the images, does segmentation
+        If mmap_gt is true, the gt grid is memory mapped (copy-on-write)
+        rather than read into memory all at once. The nans in the gt grid
+        are set to -mu. If gt_cache_dir is also given, a copy of tsdf.dat
+        with this already done is kept in gt_cache_dir, and mapped instead
+        (see voxel_data.filled_dat_file)
+        If load_gt is false, tsdf.dat is never read and gt_tsdf is None. The
+        visible tsdf is then carved into a grid with the shape and transform
+        given in tsdf_meta.yaml. Can't be used with segment_with_gt
         '''
+        if not load_gt and segment and segment_with_gt:
+            raise Exception("Can't segment with the ground truth without "
+                            "loading it")
+
         self.sequence = sequence
 
         # load in the ground truth grid for this scene, and converting nans
         voxel_data_path = sequence['folder'] + sequence['scene'] + '/tsdf.dat'
         voxel_meta_path = sequence['folder'] + sequence['scene'] + '/tsdf_meta.yaml'
 
-        self.gt_tsdf = voxel_data.WorldVoxels.load_from_dat(
-            voxel_data_path, voxel_meta_path)
+        if load_gt:
+            self.gt_tsdf = voxel_data.WorldVoxels.load_from_dat(
+                voxel_data_path, voxel_meta_path, mmap=mmap_gt,
+                nan_value=-self.mu, filled_cache_dir=gt_cache_dir)
+            self.gt_tsdf.set_origin(self.gt_tsdf.origin, self.gt_tsdf.R)
+            grid_geometry = self.gt_tsdf
+        else:
+            self.gt_tsdf = None
+            grid_geometry = voxel_data.WorldVoxels.load_blank_from_dat_meta(
+                voxel_meta_path)
+            grid_geometry.set_origin(grid_geometry.origin, grid_geometry.R)
 
         # this i s a nasty hack, which I have to do because I was foolish and carved
         # each set of data with a different offset.
@@ -157,9 +288,6 @@ class Scene(object):
 
         self.floor_height = floor_height
 
-        self.gt_tsdf.V[np.isnan(self.gt_tsdf.V)] = -self.mu
-        self.gt_tsdf.set_origin(self.gt_tsdf.origin, self.gt_tsdf.R)
-
         # loading in the image
         sequence_frames = sequence['frames'][frame_nos]
 
@@ -184,7 +312,7 @@ class Scene(object):
             video.frames = [self.im]
             carver = carving.Fusion()
             carver.set_video(video)
-            carver.set_voxel_grid(self.gt_tsdf.blank_copy())
+            carver.set_voxel_grid(grid_geometry.blank_copy())
             self.im_tsdf, self.im_visible = carver.fuse(self.mu, inlier_threshold=2)
 
             # computing normals...
@@ -209,9 +337,9 @@ class Scene(object):
         if segment and segment_with_gt:
 
             if segment_base:
-                temp_tsdf = deepcopy(self.gt_tsdf)
+                temp_tsdf = self.gt_tsdf.copy(grids=[])
                 height_in_vox = int(segment_base / self.gt_tsdf.vox_size)
-                temp_tsdf.V = temp_tsdf.V[:, :, height_in_vox:]
+                temp_tsdf.V = self.gt_tsdf.V[:, :, height_in_vox:]
             else:
                 temp_tsdf = self.gt_tsdf
 
@@ -251,41 +379,8 @@ class Scene(object):
         In this code I am assuming that the voxel grid and image have
         both got label attributes.
         '''
-        world_xyz = self.im.get_world_xyz()
-        world_norms = self.im.get_world_normals()
-
-        # convert to linear idx
-        point_idx = index[0] * self.im.mask.shape[1] + index[1]
-
-        shoebox = voxel_data.ShoeBox(self.voxlet_params['shape'], np.float32)
+        shoebox = self._initialise_voxlets(np.atleast_2d(index)).get_shoebox(0)
         shoebox.V *= np.nan
-        # shoebox.V += self.mu  # set the outside area to -mu
-
-        start_x = world_xyz[point_idx, 0]
-        start_y = world_xyz[point_idx, 1]
-
-        if self.voxlet_params['tall_voxlets']:
-            start_z = self.voxlet_params['tall_voxlet_height']
-            vox_centre = \
-                np.array(self.voxlet_params['shape'][:2]) * \
-                self.voxlet_params['size'] * \
-                np.array(self.voxlet_params['relative_centre'][:2])
-            vox_centre = np.append(vox_centre, start_z)
-        else:
-            vox_centre = \
-                np.array(self.voxlet_params['shape']) * \
-                self.voxlet_params['size'] * \
-                np.array(self.voxlet_params['relative_centre'])
-            start_z = world_xyz[point_idx, 2]
-
-        shoebox.set_p_from_grid_origin(vox_centre)  # m
-        shoebox.set_voxel_size(self.voxlet_params['size'])  # m
-        shoebox.initialise_from_point_and_normal(
-            np.array([start_x, start_y, start_z]),
-            world_norms[point_idx],
-            np.array([0, 0, 1]))
-
-        #pickle.dump(shoebox, open('/tmp/sbox.pkl', 'w'), protocol=pickle.HIGHEST_PROTOCOL)
 
         # getting a copy of the voxelgrid, in which only the specified label exists
         if extract_from == 'gt_tsdf':
@@ -318,6 +413,72 @@ class Scene(object):
         else:
             return shoebox
 
+    def _initialise_voxlets(self, idxs):
+        '''
+        Returns a ShoeBoxBatch of voxlets, positioned at each of the Nx2 image
+        indices idxs
+        '''
+        # convert to linear idx
+        point_idxs = idxs[:, 0] * self.im.mask.shape[1] + idxs[:, 1]
+
+        return voxel_data.ShoeBoxBatch.from_voxlet_params(
+            self.im.get_world_xyz()[point_idxs],
+            self.im.get_world_normals()[point_idxs],
+            self.voxlet_params)
+
+    def extract_voxlets(self, idxs, extract_from, interpolation='nearest'):
+        '''
+        Batched version of extract_single_voxlet, extracting a voxlet at each
+        of the Nx2 image indices idxs.
+        interpolation is how the grid is sampled, 'nearest' or 'trilinear'.
+        Returns an N x num_voxels float32 array, one flattened voxlet per row
+        '''
+        voxlets = self._initialise_voxlets(idxs)
+
+        if extract_from == 'gt_tsdf':
+            these_labels = self.gt_im_label[idxs[:, 0], idxs[:, 1]]
+            return self._extract_voxlets_by_label(
+                voxlets, these_labels, self.gt_tsdf_separate, self.gt_tsdf,
+                interpolation)
+
+        elif extract_from == 'visible_tsdf':
+            these_labels = self.visible_im_label[idxs[:, 0], idxs[:, 1]]
+            return self._extract_voxlets_by_label(
+                voxlets, these_labels, self.visible_tsdf_separate,
+                interpolation=interpolation)
+
+        elif extract_from == 'im_tsdf':
+            return voxlets.fill_from_grid(
+                self.im_tsdf, interpolation=interpolation)
+
+        elif extract_from == 'actual_tsdf':
+            return voxlets.fill_from_grid(
+                self.gt_tsdf, interpolation=interpolation)
+        else:
+            raise Exception("Don't know how to extract from %s" % extract_from)
+
+    def _extract_voxlets_by_label(self, voxlets, these_labels, separate_grids,
+            nan_label_grid=None, interpolation='nearest'):
+        '''
+        Fills each voxlet from the grid in separate_grids given by its label.
+        Voxlets with a nan label are filled from nan_label_grid
+        '''
+        output = np.empty((len(voxlets), voxlets.num_voxels()), np.float32)
+
+        nan_labels = np.isnan(these_labels)
+        if np.any(nan_labels):
+            # this shouldn't happen too much, only due to rounding errors
+            print "Nan in sampled point"
+            output[nan_labels] = voxlets[nan_labels].fill_from_grid(
+                nan_label_grid, interpolation=interpolation)
+
+        for label in np.unique(these_labels[~nan_labels]):
+            this_label = these_labels == label
+            output[this_label] = voxlets[this_label].fill_from_grid(
+                separate_grids[label], interpolation=interpolation)
+
+        return output
+
     def set_gt_tsdf(self, tsdf_in, floor_height=None):
         self.gt_tsdf = deepcopy(tsdf_in)
 
@@ -331,16 +492,21 @@ class Scene(object):
     def set_im(self, im):
         self.im = im
 
-    def get_visible_frustrum(self):
+    def get_visible_frustrum(self, skip_blocks=None):
         '''
         returns a boolean voxel grid with ones where the voxel is in the
         frustrum of any of the cameras, and zeros otherwise...
         Warning - just doing for a single image, not for a video!
+        skip_blocks are 8x8x8 blocks of voxels which needn't be tested, and
+        are returned as zeros (see carving.VoxelAccumulator.voxels_inside_image)
         '''
         carver = carving.VoxelAccumulator()
-        carver.set_voxel_grid(self.gt_tsdf.blank_copy())
-        inside, _, _ = carver.project_voxels(self.im)
-        return inside
+        # only the shape and transform of the grid are used
+        if self.gt_tsdf is not None:
+            carver.set_voxel_grid(self.gt_tsdf)
+        else:
+            carver.set_voxel_grid(self.im_tsdf)
+        return carver.voxels_inside_image(self.im, skip_blocks=skip_blocks)
 
     def santity_render(self, save_folder):
         '''
@@ -424,7 +590,7 @@ class Scene(object):
         labels3d = np.expand_dims(labels, axis=2)
         labels3d = np.tile(labels3d, (1, 1, tsdf.V.shape[2]))
 
-        labels_3d_grid = tsdf.copy()
+        labels_3d_grid = tsdf.copy(grids=[])
         labels_3d_grid.V = labels3d
         labels_3d_grid.V[:, :, :floor_height] = 0
 
@@ -471,13 +637,23 @@ class Scene(object):
         '''
         forms a region of the grid which we should evaluate over
         '''
-        temp = np.logical_or(self.im_tsdf.V < 0, np.isnan(self.im_tsdf.V))
-        voxels_to_evaluate = np.logical_and(
-            temp, self.get_visible_frustrum().reshape(temp.shape))
-
-        floor_t = self.gt_tsdf.blank_copy()
-        floor_t.V[:, :, :6] = 1
-        voxels_to_evaluate = np.logical_and(floor_t.V == 0, voxels_to_evaluate)
+        # 8x8x8 blocks of the im_tsdf which are all observed empty space are
+        # never evaluated, so don't need testing against the frustrum
+        pyramid = voxel_data.GridPyramid(self.im_tsdf)
+        _, _, any_nan = pyramid.summary(3)
+        maybe_evaluated = np.logical_or(
+            pyramid.blocks_in_range(3, -np.inf, 0), any_nan)
+        visible = self.get_visible_frustrum(skip_blocks=~maybe_evaluated)
+
+        # of the visible voxels, the full or unobserved ones are evaluated
+        visible_idxs = np.flatnonzero(visible)
+        values = self.im_tsdf.V.ravel()[visible_idxs]
+        voxels_to_evaluate = np.zeros(self.im_tsdf.V.shape, dtype=bool)
+        voxels_to_evaluate.ravel()[visible_idxs] = \
+            np.logical_or(values < 0, np.isnan(values))
+
+        # the floor is not evaluated
+        voxels_to_evaluate[:, :, :6] = False
 
         if extra_mask is not None:
             voxels_to_evaluate = np.logical_and(extra_mask, voxels_to_evaluate)
@@ -489,9 +665,9 @@ class Scene(object):
         evalutes a prediction grid, assuming to be the same size and position
         as the ground truth grid...
         '''
-        assert(V.shape[0] == self.gt_tsdf.V.shape[0])
-        assert(V.shape[1] == self.gt_tsdf.V.shape[1])
-        assert(V.shape[2] == self.gt_tsdf.V.shape[2])
+        assert(V.shape[0] == self.gt_tsdf.shape[0])
+        assert(V.shape[1] == self.gt_tsdf.shape[1])
+        assert(V.shape[2] == self.gt_tsdf.shape[2])
 
         # deciding which voxels to evaluate over...
         if voxels_to_evaluate is None:
@@ -499,7 +675,8 @@ class Scene(object):
             self.voxels_to_evaluate = voxels_to_evaluate
 
         # getting the ground truth TSDF voxels
-        gt = self.gt_tsdf.V[voxels_to_evaluate] < 0
+        # (get_indicated_voxels, so the gt can be a SparseTSDF)
+        gt = self.gt_tsdf.get_indicated_voxels(voxels_to_evaluate) < 0
         if np.isnan(gt).sum() > 0:
             raise Exception('Oops, should not be nans here')
 
@@ -0,0 +1,63 @@
+'''
+Wall time and counters for each stage of a computation, so that slow stages
+can be found and regressions spotted
+'''
+import json
+import time
+from contextlib import contextmanager
+
+
+class StageTimer(object):
+    '''
+    Adds up the wall time spent in each named stage, and keeps named counters.
+    A stage can be entered many times; its times and number of calls are
+    summed.
+    '''
+
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        use as:
+            with timer.stage('forest'):
+                ...
+        '''
+        tic = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - tic)
+
+    def add_time(self, name, seconds, calls=1):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    def count(self, name, number=1):
+        self.counters[name] = self.counters.get(name, 0) + int(number)
+
+    def merge(self, other):
+        '''
+        adds in the times and counters from another StageTimer, e.g. one
+        kept by a worker process. The times of stages run in parallel are
+        summed, so can add up to more than the wall time
+        '''
+        for name in other.times:
+            self.add_time(name, other.times[name], other.calls[name])
+        for name in other.counters:
+            self.count(name, other.counters[name])
+
+    def as_dict(self):
+        return {'times': dict(self.times),
+                'calls': dict(self.calls),
+                'counters': dict(self.counters)}
+
+    def save(self, savepath):
+        '''
+        saves the times and counters as json
+        '''
+        with open(savepath, 'w') as f:
+            json.dump(self.as_dict(), f, indent=4, sort_keys=True)
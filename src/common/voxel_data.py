@@ -4,8 +4,11 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import os
 import sys
+import hashlib
 import numpy as np
 import copy
+import itertools
+import collections
 from numbers import Number
 import subprocess as sp
 
@@ -19,6 +22,7 @@ from scipy.ndimage.morphology import distance_transform_edt
 
 # Custom
 import mesh
+import chunked_storage
 
 
 def load_voxels(loadpath):
@@ -26,11 +30,209 @@ def load_voxels(loadpath):
         return pickle.load(f)
 
 
+class MeshgridCache(object):
+    '''
+    A least recently used store of meshgrids, which can be shared by all the
+    grids in a process. Grids of the same shape and transform (e.g. the blank
+    copies made in carving and scene) then each compute a meshgrid only once.
+    At most max_bytes of meshgrids are kept.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._meshgrids = collections.OrderedDict()
+
+    def get(self, key):
+        '''returns the meshgrid stored under key, or None'''
+        if key not in self._meshgrids:
+            self.misses += 1
+            return None
+
+        # moving to the most recently used end
+        self.hits += 1
+        meshgrid = self._meshgrids.pop(key)
+        self._meshgrids[key] = meshgrid
+        return meshgrid
+
+    def put(self, key, meshgrid):
+        if meshgrid.nbytes > self.max_bytes:
+            return
+
+        if key in self._meshgrids:
+            self.nbytes -= self._meshgrids.pop(key).nbytes
+        self._meshgrids[key] = meshgrid
+        self.nbytes += meshgrid.nbytes
+
+        while self.nbytes > self.max_bytes:
+            _, oldest = self._meshgrids.popitem(last=False)
+            self.nbytes -= oldest.nbytes
+
+    def clear(self):
+        self._meshgrids.clear()
+        self.nbytes = 0
+
+
+# the process-wide meshgrid cache, off unless use_shared_meshgrid_cache is called
+shared_meshgrid_cache = None
+
+
+def use_shared_meshgrid_cache(max_bytes):
+    '''
+    Shares meshgrids between all grids, up to max_bytes in total.
+    A max_bytes of None or 0 turns the sharing off again
+    '''
+    global shared_meshgrid_cache
+    if max_bytes:
+        shared_meshgrid_cache = MeshgridCache(max_bytes)
+    else:
+        shared_meshgrid_cache = None
+
+
+# the meta of each dat file already loaded in this process, keyed on the yaml
+# path and holding the yaml's modification time as well as the meta itself
+_dat_meta_cache = {}
+
+
+def load_dat_meta(meta_yaml_file):
+    '''
+    Loads the R, T, voxelsize and shape of a dat file from its yaml meta file.
+    Parsing the yaml is slow, so the meta is also saved in a binary npz
+    sidecar next to the yaml (meta_yaml_file + '.npz'), which is used in
+    place of the yaml while it is newer than it, and kept in memory for the
+    rest of the process
+    '''
+    mtime = os.path.getmtime(meta_yaml_file)
+    if meta_yaml_file in _dat_meta_cache:
+        cached_mtime, meta = _dat_meta_cache[meta_yaml_file]
+        if cached_mtime == mtime:
+            return meta
+
+    sidecar = meta_yaml_file + '.npz'
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= mtime:
+        loaded = np.load(sidecar)
+        meta = {'R': loaded['R'].tolist(),
+                'T': loaded['T'].tolist(),
+                'voxelsize': float(loaded['voxelsize']),
+                'shape': tuple(loaded['shape'].tolist())}
+    else:
+        loader = getattr(yaml, 'CLoader', yaml.Loader)
+        with open(meta_yaml_file) as f:
+            meta = yaml.load(f, Loader=loader)
+        meta['shape'] = tuple(meta['shape'])
+        # written to a temporary file first, so a process reading the
+        # sidecar never sees it half written
+        temp_path = _temp_path(sidecar)
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, R=meta['R'], T=meta['T'],
+                         voxelsize=meta['voxelsize'], shape=meta['shape'])
+            os.rename(temp_path, sidecar)
+        except (IOError, OSError):
+            # e.g. a read only dataset; the yaml is parsed again next time
+            _remove_if_exists(temp_path)
+
+    _dat_meta_cache[meta_yaml_file] = (mtime, meta)
+    return meta
+
+
+def _temp_path(path):
+    '''a temporary path next to path, unique to this process'''
+    return path + '.%d.tmp' % os.getpid()
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _filled_dat_path(dat_file, nan_value, cache_dir):
+    '''
+    the path in cache_dir of the filled copy of dat_file. The name starts
+    with a hash of the full path, as many dat files are called tsdf.dat
+    '''
+    dat_file = os.path.abspath(dat_file)
+    return os.path.join(cache_dir, '%s_%s.nan_%r.dat' % (
+        hashlib.md5(dat_file).hexdigest()[:16], os.path.basename(dat_file),
+        float(nan_value)))
+
+
+def filled_dat_file(dat_file, shape, nan_value, cache_dir, chunk_size=16):
+    '''
+    Returns the path of a copy of the dat file with its nans replaced by
+    nan_value, so the copy can be memory mapped without having to touch
+    every page to fill the nans. The copies are kept in cache_dir, never
+    next to the dat files, so the dataset itself is left untouched; the
+    cache can be deleted at any time. The copy is made the first time it is
+    needed (chunk_size slices at a time, to save memory), and again whenever
+    the dat file is newer. Returns None if the copy can't be written.
+    '''
+    filled_path = _filled_dat_path(dat_file, nan_value, cache_dir)
+    if os.path.exists(filled_path) and \
+            os.path.getmtime(filled_path) >= os.path.getmtime(dat_file):
+        return filled_path
+
+    temp_path = _temp_path(filled_path)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        V = np.memmap(dat_file, dtype=np.float16, mode='r', shape=shape)
+        with open(temp_path, 'wb') as f:
+            for start in range(0, shape[0], chunk_size):
+                chunk = np.array(V[start:start + chunk_size])
+                chunk[np.isnan(chunk)] = nan_value
+                chunk.tofile(f)
+        del V
+        os.rename(temp_path, filled_path)
+    except (IOError, OSError):
+        _remove_if_exists(temp_path)
+        return None
+
+    return filled_path
+
+
+def _apply_affine(points, affine, dtype, out=None):
+    '''
+    Applies the 3x4 affine transform to the nx3 points in a single pass,
+    computing in dtype. The result is written into out if given, which
+    must be a C-contiguous nx3 array of type dtype
+    '''
+    affine = affine.astype(dtype)
+    # (doing transpose twice is quicker for long thin arrays of points)
+    transformed = np.dot(affine[:, :3], points.astype(dtype, copy=False).T).T
+    return np.add(transformed, affine[:, 3], out=out)
+
+
+def _scatter_add(V, flat_idxs, values=None):
+    '''
+    Adds values (or one, if values is None) onto V at the linear indices in
+    flat_idxs, correctly summing any repeated indices. Only the span of V
+    between the smallest and largest index is touched.
+    V must be C-contiguous so that the addition happens in place
+    '''
+    if flat_idxs.size == 0:
+        return
+
+    assert V.flags.c_contiguous
+    lowest = flat_idxs.min()
+    summed = np.bincount(flat_idxs - lowest, weights=values)
+    flat_V = V.reshape(-1)
+    flat_V[lowest:lowest + summed.shape[0]] += summed
+
+
 class Voxels(object):
     '''
     voxel data base class - this will be parent of regular voxels and frustrum voxels
     '''
 
+    # the arrays of self which hold grid data, as opposed to metadata.
+    # Subclasses which keep other grids (e.g. accumulators) add them here
+    grid_names = ('V',)
+
     def __init__(self, size, datatype):
         '''Initialise the numpy voxel grid to the correct size'''
         assert np.prod(size) < 500e6    # check to catch excess allocation
@@ -54,19 +256,65 @@ class Voxels(object):
 
         savemat(mat_path, self.__dict__)
 
-    def copy(self):
-        '''Returns a deep copy of self'''
-        return copy.deepcopy(self)
+    def __getstate__(self):
+        '''
+        The cached meshgrids can be much bigger than V, so are not pickled
+        or copied; they are recomputed if needed.
+        A memory mapped V is pickled and copied as a plain array
+        '''
+        state = dict((key, value) for key, value in self.__dict__.items()
+                     if not key.startswith('_cached_'))
+        if isinstance(state.get('V'), np.memmap):
+            state['V'] = np.asarray(state['V'])
+        return state
+
+    def copy(self, grids=None, views=()):
+        '''
+        Returns a deep copy of self.
+        The grids of self (the arrays named in grid_names: V, and e.g. sumV
+        and countV of an accumulator) are only copied if named in grids, or
+        if grids is None.
+        Grids named in views are shared with self as read only views, which
+        cost nothing; to change one, replace it with a copy first.
+        Any other grids are left out of the copy, e.g. copy(grids=[]) copies
+        just the transform and other metadata, ready for a new V.
+        '''
+        temp = self.__class__.__new__(self.__class__)
+        for key, value in self.__getstate__().items():
+            if key in self.grid_names and isinstance(value, np.ndarray):
+                if key in views:
+                    value = value.view()
+                    value.flags.writeable = False
+                elif grids is None or key in grids:
+                    value = value.copy()
+                else:
+                    continue
+            else:
+                value = copy.deepcopy(value)
+            temp.__dict__[key] = value
+        return temp
 
-    def blank_copy(self):
-        '''Returns a copy of self, but with all voxels empty'''
-        temp = copy.deepcopy(self)
+    def blank_copy(self, dtype=None):
+        '''
+        Returns a copy of self, but with all voxels empty (of type dtype, if
+        given). V is not copied, just allocated again
+        '''
+        grids = [key for key in self.grid_names if key != 'V']
+        temp = self.copy(grids=grids)
         # not using temp.V*=0 in case nans are present
-        temp.V = np.zeros(temp.V.shape, temp.V.dtype)
+        temp.V = np.zeros(self.shape, dtype or self.V.dtype)
         return temp
 
+    @property
+    def shape(self):
+        '''
+        The shape of the grid. Grids which don't hold a dense V (e.g.
+        SparseTSDF) override this
+        '''
+        return self.V.shape
+
     def num_voxels(self):
-        return np.prod(self.V.shape)
+        return np.prod(self.shape)
 
     def set_indicated_voxels(self, binary_array, values):
         '''
@@ -122,11 +370,11 @@ class Voxels(object):
         Returns a logical array the same length as idx, with true
         where idx is within the range of self.V, and false otherwise
         '''
-        return np.logical_and.reduce((idx[:, 0] < self.V.shape[0],
+        return np.logical_and.reduce((idx[:, 0] < self.shape[0],
                                        idx[:, 0] >= 0,
-                                       idx[:, 1] < self.V.shape[1],
+                                       idx[:, 1] < self.shape[1],
                                        idx[:, 1] >= 0,
-                                       idx[:, 2] < self.V.shape[2],
+                                       idx[:, 2] < self.shape[2],
                                        idx[:, 2] >= 0))
 
     def extract_from_indices(self, idxs, check_bounds=False):
@@ -164,9 +412,9 @@ class Voxels(object):
         returns 8x3 array of the corners of the voxel grid in world space coordinates
         '''
         corners = []
-        for i in [0, self.V.shape[0]]:
-            for j in [0, self.V.shape[1]]:
-                for k in [0, self.V.shape[2]]:
+        for i in [0, self.shape[0]]:
+            for j in [0, self.shape[1]]:
+                for k in [0, self.shape[2]]:
                     corners.append([i, j, k])
 
         return self.idx_to_world(np.array(corners))
@@ -180,27 +428,63 @@ class Voxels(object):
         trans_outside = distance_transform_edt(1-self.V.astype(float))
         return trans_outside - trans_inside
 
-    def compute_tsdf(self, truncation):
+    def compute_tsdf(self, truncation, out=None, brick_size=32):
         '''
         computes tsdf in real world units
         truncation limit (mu in kinfupaper) needs to be set
-        '''
-        sdf = self.compute_sdt()
-
-        # convert to real-world distances
-        sdf *= self.vox_size
-
-        # truncate
-        sdf[sdf > truncation] = truncation
-        sdf[sdf < -truncation] = -truncation
-
-        return sdf
+        Only voxels near the surface need a distance transform, as all the
+        others are truncated. The grid is split into bricks, and the distance
+        transform is done for each brick which the surface is within
+        truncation of, over just the brick plus a margin of the truncation
+        distance. This gives the same tsdf as compute_sdt over the whole grid.
+        The tsdf is written into out if given (e.g. a float16 array the shape
+        of V), otherwise into a new float32 array, which is returned
+        '''
+        if out is None:
+            out = np.empty(self.V.shape, np.float32)
+
+        occupied = self.V != 0
+        shape = np.array(self.V.shape)
+        margin = int(np.ceil(truncation / self.vox_size))
+
+        for brick_start in itertools.product(
+                *[range(0, size, brick_size) for size in shape]):
+            brick_start = np.array(brick_start)
+            brick_end = np.minimum(brick_start + brick_size, shape)
+            brick = tuple(slice(s, e) for s, e in zip(brick_start, brick_end))
+
+            # the brick and the margin around it
+            padded_start = np.maximum(brick_start - margin, 0)
+            padded_end = np.minimum(brick_end + margin, shape)
+            padded = occupied[tuple(slice(s, e) for s, e in
+                                    zip(padded_start, padded_end))]
+
+            # no surface within truncation of the brick
+            if padded.all():
+                out[brick] = -truncation
+                continue
+            elif not padded.any():
+                out[brick] = truncation
+                continue
+
+            sdf = distance_transform_edt(~padded)
+            sdf -= distance_transform_edt(padded)
+            sdf = sdf[tuple(slice(s, e) for s, e in zip(
+                brick_start - padded_start, brick_end - padded_start))]
+
+            # convert to real-world distances, and truncate
+            sdf *= self.vox_size
+            np.clip(sdf, -truncation, truncation, out=sdf)
+            out[brick] = sdf
+
+        return out
 
     def convert_to_tsdf(self, truncation):
         '''
         converts binary grid to a tsdf
         '''
-        self.V = self.compute_tsdf(truncation).astype(np.float16)
+        tsdf = np.empty(self.V.shape, np.float16)
+        self.V = self.compute_tsdf(truncation, out=tsdf)
 
     def save(self, filename):
         '''
@@ -223,18 +507,57 @@ class WorldVoxels(Voxels):
         pass
 
     @classmethod
-    def load_from_dat(cls, dat_file, meta_yaml_file):
+    def load_from_dat(cls, dat_file, meta_yaml_file, mmap=False,
+            nan_value=None, filled_cache_dir=None):
         '''
         Initialise and load data from a binary dat file, and load
         metadata from a yaml file. This is a very efficient file format
         when compared to pkl, mat etc
+        If mmap is true, V is a copy-on-write memory map of the dat file, so
+        only the pages which are used are read, and changes to V are never
+        written back to the file
+        If nan_value is given, the nans in the grid are replaced with it.
+        Filling a memory map reads (and privately copies) every page, so if
+        filled_cache_dir is given a copy of the dat file with the nans
+        already filled is kept there, and mapped instead (see
+        filled_dat_file)
+        '''
+        meta = load_dat_meta(meta_yaml_file)
+        if mmap and nan_value is not None and filled_cache_dir is not None:
+            filled_path = filled_dat_file(
+                dat_file, meta['shape'], nan_value, filled_cache_dir)
+            if filled_path is not None:
+                dat_file = filled_path
+                nan_value = None
+
+        vox = cls()
+        vox.R = np.array(meta['R']).reshape((3, 3))
+        vox.origin = np.array(meta['T'])
+        vox.vox_size = meta['voxelsize']
+        if mmap:
+            vox.V = np.memmap(
+                dat_file, dtype=np.float16, mode='c', shape=meta['shape'])
+        else:
+            vox.V = np.fromfile(
+                dat_file, dtype=np.float16).reshape(meta['shape'])
+
+        if nan_value is not None:
+            vox.V[np.isnan(vox.V)] = nan_value
+        return vox
+
+    @classmethod
+    def load_blank_from_dat_meta(cls, meta_yaml_file, dtype=np.float16):
         '''
-        meta = yaml.load(open(meta_yaml_file))
+        An empty (all zero) grid with the shape and transform given in the
+        meta file of a dat file. The dat file itself is never read, so
+        needn't exist
+        '''
+        meta = load_dat_meta(meta_yaml_file)
         vox = cls()
         vox.R = np.array(meta['R']).reshape((3, 3))
         vox.origin = np.array(meta['T'])
         vox.vox_size = meta['voxelsize']
-        vox.V = np.fromfile(dat_file, dtype=np.float16).reshape(meta['shape'])
+        vox.V = np.zeros(meta['shape'], dtype)
         return vox
 
     def save_to_dat(self, dat_file, meta_yaml_file=None):
@@ -251,6 +574,37 @@ class WorldVoxels(Voxels):
                     'shape': self.V.shape}
             yaml.dump(meta, open(meta_yaml_file, 'w'))
 
+            # the binary copy of the old meta is now out of date
+            _dat_meta_cache.pop(meta_yaml_file, None)
+            if os.path.exists(meta_yaml_file + '.npz'):
+                os.remove(meta_yaml_file + '.npz')
+
+    def save_to_chunked(self, savepath, chunk_size=32, compression='zlib'):
+        '''
+        Saves V and the transform to a chunked, compressed file.
+        Unlike save_to_dat, V keeps its dtype
+        '''
+        chunked_storage.save_chunked(savepath, self.V, self.R, self.origin,
+            self.vox_size, chunk_size, compression)
+
+    @classmethod
+    def load_from_chunked(cls, loadpath, start=None, end=None, processes=1):
+        '''
+        Loads a grid saved with save_to_chunked. If start and end are given,
+        only the voxels from start up to end are loaded, and the origin is
+        moved to match
+        '''
+        reader = chunked_storage.ChunkedGridReader(loadpath)
+        vox = cls()
+        vox.V = reader.read_region(start, end, processes)
+        vox.vox_size = reader.vox_size
+        origin = reader.origin
+        if start is not None:
+            origin = origin + np.dot(
+                reader.R, np.asarray(start) * reader.vox_size)
+        vox.set_origin(origin, reader.R)
+        return vox
+
     def init_and_populate(self, indices):
         '''
         Initialises the grid and populates, based on the indices in idx
@@ -283,53 +637,128 @@ class WorldVoxels(Voxels):
 
     def _clear_cache(self):
         '''
-        clears cached items, should call this after a change in origin or rotation etc
+        clears cached items. The meshgrid caches are keyed on the shape and
+        transform of the grid so are never stale, but this frees the memory
         '''
-        if hasattr(self, '_cached_world_meshgrid'):
-            self._cached_world_meshgrid = []
+        self._cached_meshgrids = {}
 
-        if hasattr(self, '_cached_idx_meshgrid'):
-            self._cached_idx_meshgrid = []
+    def _meshgrid_key(self, kind):
+        '''
+        The key a meshgrid is cached under. This is cheap to compute, and
+        changes with the shape of V and, for the world meshgrids, with the
+        transform (which is sometimes set directly rather than with set_origin)
+        '''
+        key = (kind, self.shape)
+        if kind.startswith('world'):
+            key += (float(self.vox_size),
+                    np.asarray(self.origin, dtype=float).tobytes(),
+                    np.asarray(self.R, dtype=float).tobytes())
+        return key
 
-    def idx_to_world(self, idx):
+    def _cached_meshgrid(self, kind, compute_meshgrid):
+        '''
+        returns the meshgrid of the given kind, only calling compute_meshgrid
+        if it isn't in the cache of self (or in the shared cache, if in use).
+        Cached meshgrids are read only, as they may be shared between grids
+        '''
+        key = self._meshgrid_key(kind)
+
+        if not hasattr(self, '_cached_meshgrids'):
+            self._cached_meshgrids = {}
+        if kind in self._cached_meshgrids and \
+                self._cached_meshgrids[kind][0] == key:
+            return self._cached_meshgrids[kind][1]
+
+        meshgrid = None
+        if shared_meshgrid_cache is not None:
+            meshgrid = shared_meshgrid_cache.get(key)
+
+        if meshgrid is None:
+            meshgrid = compute_meshgrid()
+            meshgrid.flags.writeable = False
+            if shared_meshgrid_cache is not None:
+                shared_meshgrid_cache.put(key, meshgrid)
+
+        self._cached_meshgrids[kind] = (key, meshgrid)
+        return meshgrid
+
+    def cached_meshgrid_nbytes(self):
+        '''
+        the number of bytes used by the meshgrids cached on self
+        '''
+        return sum(meshgrid.nbytes for _, meshgrid in
+                   getattr(self, '_cached_meshgrids', {}).values())
+
+    def _affine_transform(self):
+        '''
+        Returns the 3x4 affine transform taking idxs to the world locations
+        of the voxel centres.
+        This is cached until the transform of the grid changes
+        '''
+        key = self._meshgrid_key('world_affine')
+        if getattr(self, '_cached_affine', (None,))[0] != key:
+            half_voxel = np.dot(self.R, 0.5 * self.vox_size * np.ones(3))
+
+            idx_to_world = np.empty((3, 4))
+            idx_to_world[:, :3] = self.R * self.vox_size
+            idx_to_world[:, 3] = self.origin + half_voxel
+
+            self._cached_affine = (key, idx_to_world)
+
+        return self._cached_affine[1]
+
+    def idx_to_world(self, idx, out=None, dtype=np.float64):
         '''
         converts an nx3 integer array, [i, j, k] coordinate to real-world 3D locations
         note that I do the 0.5 offset as I am treating idxs as voxel centres
-        of course this should really be done in one homogeneoous transform...
+        In float32 this is a single precomputed affine transform. The result
+        is written into out if given (an nx3 C-contiguous array of type dtype)
         '''
         assert(idx.shape[1]==3)
 
-        # applying scaling
+        if np.dtype(dtype) != np.float64:
+            return _apply_affine(idx, self._affine_transform(), dtype, out)
+
+        # in float64 the steps are kept separate, so voxel centres which lie
+        # exactly on the voxel boundaries of other grids always round the same way
         scaled_idx = (idx.astype(float)+0.5) * self.vox_size
         scaled_rotated_idx = np.dot(self.R, scaled_idx.T).T
 
         # applying the real-world offset
-        world_coords = scaled_rotated_idx + self.origin
-
-        return world_coords
+        return np.add(scaled_rotated_idx, self.origin, out=out)
 
-    def world_to_idx(self, xyz, detect_out_of_range=False):
+    def world_to_idx(self, xyz, detect_out_of_range=False, out=None):
         '''
         converts an nx3 world coordinates, [x, y, z], to ijk locations
         if detect_out_of_range is true, then also returns a logical array saying which are
         in range of the grid locations
+        If out is given (an nx3 integer array, e.g. int32) the idxs are
+        written into it rather than into a new int64 array.
         '''
         assert(xyz.shape[1]==3)
 
-        # applying translate
-        translated_xyz = xyz - self.origin
-
-        # ...scaling
-        scaled_translated_xyz = translated_xyz / self.vox_size
+        # translating, scaling then rotating in float64, as points exactly on
+        # voxel boundaries are common with upright grids and must round the same
+        # way each time (doing transpose twice seems to be quicker than np.dot(xyz, inv_R.T) )
+        scaled_translated_xyz = (xyz - self.origin) / self.vox_size
+        continuous_idx = np.dot(self.inv_R, scaled_translated_xyz.T).T
 
-        # finally rotating
-        # note that (doing transpose twice seems to be quicker than np.dot(xyz, inv_R.T) )
-        scaled_translated_rotated_xyz = np.dot(self.inv_R, scaled_translated_xyz.T).T
+        np.floor(continuous_idx, out=continuous_idx)
 
-        idx = np.floor(scaled_translated_rotated_xyz).astype(np.int)
+        if detect_out_of_range:
+            # worked out before the conversion to int, so nans are invalid
+            with np.errstate(invalid='ignore'):
+                valid = np.logical_and(
+                    np.all(continuous_idx >= 0, axis=1),
+                    np.all(continuous_idx < self.shape, axis=1))
+
+        if out is None:
+            idx = continuous_idx.astype(np.int)
+        else:
+            np.copyto(out, continuous_idx, casting='unsafe')
+            idx = out
 
         if detect_out_of_range:
-            valid = self.find_valid_idx(idx)
             return idx, valid
         else:
             return idx
@@ -346,125 +775,219 @@ class WorldVoxels(Voxels):
         full = np.concatenate((half, np.array([[0, 0, 0, 1]])), axis=0)
         return full
 
-    def just_valid_world_to_idx(self, xyz, detect_out_of_range=False):
+    def just_valid_world_to_idx(self, xyz, detect_out_of_range=False,
+            interpolation='nearest'):
         '''
         as world_to_idx, but only returns the values of the valid idx locations,
         also returns a binary array indicating which these were
         valid_idxs are the locations of the values from self which were pulled out
+        interpolation can be 'nearest' or 'trilinear'
         '''
         assert(xyz.shape[1]==3)
         idxs, valid = self.world_to_idx(xyz, True)
 
         valid_idxs = idxs[valid, :]
-        values = self.get_idxs(valid_idxs)
+        if interpolation == 'nearest':
+            values = self.get_idxs(valid_idxs)
+        elif interpolation == 'trilinear':
+            values = self.trilinear_interpolate(xyz[valid, :])
+        else:
+            raise Exception("Unknown interpolation %s" % interpolation)
 
         return values, valid, valid_idxs
 
+    def trilinear_interpolate(self, xyz):
+        '''
+        Trilinear interpolation of the grid at the nx3 world locations xyz,
+        treating each voxel value as being at the voxel centre.
+        Neighbouring voxels which are nan (e.g. unobserved) or outside the grid
+        are left out, and the weights of the others renormalised. Locations
+        with no usable neighbours are given nan.
+        '''
+        assert(xyz.shape[1]==3)
+
+        # the continuous idx, with the voxel centres at whole numbers
+        continuous_idx = np.dot(
+            self.inv_R, ((xyz - self.origin) / self.vox_size).T).T - 0.5
+        lower_idx = np.floor(continuous_idx).astype(int)
+        fraction = continuous_idx - lower_idx
+
+        weighted_sum = np.zeros(xyz.shape[0])
+        weight_total = np.zeros(xyz.shape[0])
+
+        for offset in itertools.product([0, 1], repeat=3):
+            neighbour_idx = lower_idx + np.array(offset)
+            weight = np.prod(
+                np.where(np.array(offset) == 1, fraction, 1 - fraction), axis=1)
+
+            neighbour_values = np.zeros(xyz.shape[0])
+            inside = self.find_valid_idx(neighbour_idx)
+            neighbour_values[inside] = self.get_idxs(neighbour_idx[inside])
+
+            usable = np.logical_and(inside, ~np.isnan(neighbour_values))
+            weighted_sum[usable] += weight[usable] * neighbour_values[usable]
+            weight_total[usable] += weight[usable]
+
+        values = np.zeros(xyz.shape[0]) * np.nan
+        has_weight = weight_total > 0
+        values[has_weight] = weighted_sum[has_weight] / weight_total[has_weight]
+        return values
+
     def idx_meshgrid(self):
         '''
         returns a meshgrid representation of the idx positions of every voxel in grid
         be careful if doing on large grids as can be memory expensive!
         '''
-        has_cached = hasattr(self, '_cached_idx_meshgrid') and \
-            len(self._cached_idx_meshgrid) > 0 and \
-            self._cached_idx_meshgrid.any()
-        if not has_cached:
-            # 0.5 offset beacuse we want the centre of the voxels
-            A, B, C = np.mgrid[0:self.V.shape[0],
-                               0:self.V.shape[1],
-                               0:self.V.shape[2]]
+        def compute_meshgrid():
+            A, B, C = np.mgrid[0:self.shape[0],
+                               0:self.shape[1],
+                               0:self.shape[2]]
 
             #C = C * self.depth_vox_size + self.d_front # scaling for depth
-            self._cached_idx_meshgrid = \
-                np.vstack((A.flatten(), B.flatten(), C.flatten())).T
+            return np.vstack((A.flatten(), B.flatten(), C.flatten())).T
 
-        return self._cached_idx_meshgrid
+        return self._cached_meshgrid('idx', compute_meshgrid)
 
     def idx_ij_meshgrid(self):
         '''
         returns a meshgrid representation of the idx positions of every voxel in grid
         be careful if doing on large grids as can be memory expensive!
         '''
-        has_cached = hasattr(self, '_cached_idx_ij_meshgrid') and \
-            len(self._cached_idx_ij_meshgrid) > 0 and \
-            self._cached_idx_ij_meshgrid.any()
-        if not has_cached:
-            # 0.5 offset beacuse we ant the centre of the voxels
-            A, B = np.mgrid[0:self.V.shape[0], 0:self.V.shape[1]]
+        def compute_meshgrid():
+            A, B = np.mgrid[0:self.shape[0], 0:self.shape[1]]
+            return np.vstack((A.flatten(), B.flatten(), (0*A).flatten())).T
 
-            self._cached_idx_ij_meshgrid = \
-                np.vstack((A.flatten(), B.flatten(), (0*A).flatten())).T
-
-        return self._cached_idx_ij_meshgrid
+        return self._cached_meshgrid('idx_ij', compute_meshgrid)
 
     def world_meshgrid(self):
         '''
         returns meshgrid representation of all the xyz positions of every point
         in the grid, transformed into world space!
-        Makes use of caching which could be dangerous... be careful!
+        The result is cached (read only) until the shape or transform changes.
+        world_meshgrid_chunks avoids holding this in memory.
         '''
-        has_cached = hasattr(self, '_cached_world_meshgrid') and \
-            len(self._cached_world_meshgrid) > 0 and \
-            self._cached_world_meshgrid.any()
-        if not has_cached:
-            idx = self.idx_meshgrid()
-            self._cached_world_meshgrid = self.idx_to_world(idx)
-
-        return self._cached_world_meshgrid
+        return self._cached_meshgrid(
+            'world', lambda: self.idx_to_world(self.idx_meshgrid()))
 
     def world_xy_meshgrid(self):
         '''
         returns meshgrid representation of all the xyz positions of every point
         in the grid, transformed into world space!
-        Makes use of caching which could be dangerous... be careful!
+        The result is cached (read only) until the shape or transform changes.
+        '''
+        return self._cached_meshgrid(
+            'world_xy', lambda: self.idx_to_world(self.idx_ij_meshgrid()))
+
+    def world_meshgrid_chunks(self, chunk_size=1000000, dtype=np.float32):
+        '''
+        Iterates over the voxels of the grid chunk_size at a time, in the same
+        order as idx_meshgrid and world_meshgrid. Yields (idx, world_xyz) for
+        each chunk, so the whole meshgrid is never held in memory (or cached).
+        world_xyz is of type dtype, or float64 if dtype is None.
+        '''
+        for start in range(0, self.num_voxels(), chunk_size):
+            end = min(start + chunk_size, self.num_voxels())
+            yield self._linear_idx_to_idx_and_world(
+                np.arange(start, end), dtype)
+
+    def linear_idx_to_world(self, linear_idxs, dtype=np.float32):
+        '''
+        returns the world locations of the voxels at the (C order) linear
+        indices linear_idxs into V, as an nx3 array of type dtype
         '''
-        has_cached = hasattr(self, '_cached_world_xy_meshgrid') and \
-            len(self._cached_world_xy_meshgrid) > 0 and \
-            self._cached_world_xy_meshgrid.any()
-        if not has_cached:
-            idx = self.idx_ij_meshgrid()
-            self._cached_world_xy_meshgrid = self.idx_to_world(idx)
+        return self._linear_idx_to_idx_and_world(linear_idxs, dtype)[1]
 
-        return self._cached_world_xy_meshgrid
+    def _linear_idx_to_idx_and_world(self, linear_idxs, dtype):
+        idx = np.array(np.unravel_index(linear_idxs, self.shape)).T.reshape(-1, 3)
+        # float32 locations (e.g. for projecting into images) come straight
+        # from the single affine transform. fill_from_grid passes None, as
+        # it must round the voxel centres into other grids exactly as before
+        if dtype is None:
+            return idx, self.idx_to_world(idx)
+        return idx, self.idx_to_world(idx, dtype=dtype)
+
+    def _combine_values(self, idx, values, combine):
+        '''
+        puts the values into the nx3 idx locations of self, with the
+        combine methods of fill_from_grid
+        '''
+        if combine == 'sum':
+            addition = self.get_idxs(idx)
+            self.set_idxs(idx, values+addition)
+        elif combine=='accumulator':
+            self.sumV[idx[:, 0], idx[:, 1], idx[:, 2]] += values
+            self.countV[idx[:, 0], idx[:, 1], idx[:, 2]] += 1
+        elif combine=='replace':
+            self.set_idxs(idx, values)
+        else:
+            raise Exception("unknown combine type")
 
     def fill_from_grid(self, input_grid, method='naive', combine='replace',
-            weights=None, keep_explicit_count=False):
+            weights=None, keep_explicit_count=False, interpolation='nearest'):
         '''
         warps input_grid into the world space of self.
         For all voxels in self.V which input_grid overlaps with,
         replace the voxel value with the corresponding value in input_grid.V
         'combine' can be sum (add onto existing elements) or replace (overwirte existing elements)
+        'interpolation' can be nearest or trilinear (not for axis_aligned),
+        which is how input_grid is sampled at the voxel centres of self
         '''
+        if interpolation != 'nearest' and method == 'axis_aligned':
+            raise Exception("axis_aligned can only use nearest interpolation")
 
         if method=='naive':
             '''
             This is slow as need to transform twice,
             and transform *all* the voxels in self
             '''
-            # 1) Compute world meshgrid for self
-            self_idx = self.idx_meshgrid()
-            self_world_xyz = self.world_meshgrid()
-
-            # 2) Warp into idx space of input_grid and
-            # 3) See which are valid idxs in input_grid
-            valid_values, valid, _ = input_grid.just_valid_world_to_idx(self_world_xyz)
-
-            # 4) Replace these values in self
-            if combine == 'sum':
-                addition = self.get_idxs(self_idx[valid, :])
-                self.set_idxs(self_idx[valid, :], valid_values+addition)
-            elif combine=='accumulator':
-                self.sumV[valid.reshape(self.sumV.shape)] += valid_values
-                self.countV[valid.reshape(self.countV.shape)] += 1
-            else:
-                self.set_idxs(self_idx[valid, :], valid_values)
+            # 1) Compute world locations for self, a chunk at a time
+            for self_idx, self_world_xyz in self.world_meshgrid_chunks(dtype=None):
+
+                # 2) Warp into idx space of input_grid and
+                # 3) See which are valid idxs in input_grid
+                valid_values, valid, _ = input_grid.just_valid_world_to_idx(
+                    self_world_xyz, interpolation=interpolation)
+
+                # 4) Replace these values in self
+                self._combine_values(self_idx[valid, :], valid_values, combine)
 
         elif method=='bounding_box':
             '''
             First transform the bounding box of input grid into self to see which
             voxels from self need to transform into the space of input grid
             '''
-            raise Exception("Not implemented yet")
+            # the outer corners of input_grid (not its voxel centres), in the
+            # continuous idx space of self
+            input_shape = input_grid.shape
+            input_corners = np.array([[i, j, k]
+                                      for i in [0, input_shape[0]]
+                                      for j in [0, input_shape[1]]
+                                      for k in [0, input_shape[2]]]) - 0.5
+            corners_world = input_grid.idx_to_world(input_corners)
+            corners_in_self = np.dot(
+                self.inv_R, ((corners_world - self.origin) / self.vox_size).T).T
+
+            # the box of voxels in self whose centres could be in input_grid
+            box_start = np.floor(corners_in_self.min(axis=0)).astype(int)
+            box_start = np.maximum(box_start, 0)
+            box_end = np.ceil(corners_in_self.max(axis=0)).astype(int)
+            box_end = np.minimum(box_end, self.V.shape)
+
+            if np.any(box_end <= box_start):
+                # input_grid doesn't overlap self at all
+                return
+
+            A, B, C = np.mgrid[box_start[0]:box_end[0],
+                               box_start[1]:box_end[1],
+                               box_start[2]:box_end[2]]
+            self_idx = np.vstack((A.flatten(), B.flatten(), C.flatten())).T
+
+            # only the voxels of self in the box are transformed, and then
+            # checked against the extent of input_grid as in the naive method
+            self_world_xyz = self.idx_to_world(self_idx)
+            valid_values, valid, _ = input_grid.just_valid_world_to_idx(
+                self_world_xyz, interpolation=interpolation)
+            self._combine_values(self_idx[valid, :], valid_values, combine)
 
         elif method=='axis_aligned':
             '''
@@ -483,9 +1006,9 @@ class WorldVoxels(Voxels):
 
             # now see which of these are valid...
             valid_ij_logical = np.logical_and.reduce((world_xy_in_input_grid_idx[:, 0] >= 0,
-                                          world_xy_in_input_grid_idx[:, 0] < input_grid.V.shape[0],
+                                          world_xy_in_input_grid_idx[:, 0] < input_grid.shape[0],
                                           world_xy_in_input_grid_idx[:, 1] >= 0,
-                                          world_xy_in_input_grid_idx[:, 1] < input_grid.V.shape[1]))
+                                          world_xy_in_input_grid_idx[:, 1] < input_grid.shape[1]))
 
             valid_ij = world_ij[valid_ij_logical, :]
             valid_ij_in_input = world_xy_in_input_grid_idx[valid_ij_logical, :]
@@ -498,60 +1021,52 @@ class WorldVoxels(Voxels):
 
             # valid denotes which rows in world are happy to be filled by the input grid
             valid = np.logical_and(world_z_in_input_grid_idx[:, 2] >= 0,
-                                   world_z_in_input_grid_idx[:, 2] < input_grid.V.shape[2])
-
-            # now fill in slice by slice...
-            valid_k_idxs = np.array(np.nonzero(valid)[0])
-
-            # keeps track of what the current slice in the shoebox is
-            current_shoebox_slice = np.nan
-
-            for world_slice_idx in valid_k_idxs:
-
-                this_z_in_input_grid = world_z_in_input_grid_idx[world_slice_idx, 2]
-
-                # don't bother extracting the data for this slice if we already have it cached in data_to_insert
-                if current_shoebox_slice != this_z_in_input_grid:
-
-                    # extract the data from this slice in the input grid
-                    # yes we overwrite each time - but we don't care as we never use it again!
-                    valid_ij_in_input[:, 2] = this_z_in_input_grid
-
-                    data_to_insert = input_grid.get_idxs(valid_ij_in_input).astype(self.V.dtype)
-                    current_shoebox_slice = this_z_in_input_grid
-
-                    if weights:
-                        weights_to_insert = weights.get_idxs(valid_ij_in_input).astype(self.V.dtype)
-
-                # now choosing where we put it in the world grid...
-                # yes we overwrite each time - but we don't care as we never use it again!
-                valid_ij[:, 2] = world_slice_idx
-
-                # TODO - save all these up and do at end
-                if combine=='accumulator':
-                    # here will do special stuff
-                    if weights:
-                        self.sumV[valid_ij[:, 0], valid_ij[:, 1], valid_ij[:, 2]] += data_to_insert * weights_to_insert
-                        self.countV[valid_ij[:, 0], valid_ij[:, 1], valid_ij[:, 2]] += weights_to_insert
-                    else:
-                        self.sumV[valid_ij[:, 0], valid_ij[:, 1], valid_ij[:, 2]] += data_to_insert
-                        self.countV[valid_ij[:, 0], valid_ij[:, 1], valid_ij[:, 2]] += 1
+                                   world_z_in_input_grid_idx[:, 2] < input_grid.shape[2])
+
+            valid_k_idxs = np.nonzero(valid)[0]
+            valid_k_in_input = world_z_in_input_grid_idx[valid_k_idxs, 2]
+
+            # every valid ij column paired with every valid slice, so the
+            # whole fill is a single gather and a single scatter
+            num_ij = valid_ij.shape[0]
+            num_k = valid_k_idxs.shape[0]
+
+            self_ijk = np.empty((num_ij * num_k, 3), dtype=int)
+            self_ijk[:, 0] = np.tile(valid_ij[:, 0], num_k)
+            self_ijk[:, 1] = np.tile(valid_ij[:, 1], num_k)
+            self_ijk[:, 2] = np.repeat(valid_k_idxs, num_ij)
+
+            input_ijk = np.empty((num_ij * num_k, 3), dtype=int)
+            input_ijk[:, 0] = np.tile(valid_ij_in_input[:, 0], num_k)
+            input_ijk[:, 1] = np.tile(valid_ij_in_input[:, 1], num_k)
+            input_ijk[:, 2] = np.repeat(valid_k_in_input, num_ij)
+
+            data_to_insert = input_grid.get_idxs(input_ijk).astype(self.V.dtype)
+
+            # each voxel of self appears only once, so no need for np.add.at
+            if combine=='accumulator':
+                self_i, self_j, self_k = self_ijk.T
+                if weights is not None:
+                    weights_to_insert = weights.get_idxs(input_ijk).astype(self.V.dtype)
+                    self.sumV[self_i, self_j, self_k] += data_to_insert * weights_to_insert
+                    self.countV[self_i, self_j, self_k] += weights_to_insert
+                else:
+                    self.sumV[self_i, self_j, self_k] += data_to_insert
+                    self.countV[self_i, self_j, self_k] += 1
 
-                    if keep_explicit_count:
-                        self.explicit_countV[valid_ij[:, 0], valid_ij[:, 1], valid_ij[:, 2]] += 1
+                if keep_explicit_count:
+                    self.explicit_countV[self_i, self_j, self_k] += 1
 
-                elif combine == 'sum':
-                    addition = self.get_idxs(valid_ij)
-                    self.set_idxs(valid_ij, data_to_insert+addition)
+            elif combine == 'sum':
+                addition = self.get_idxs(self_ijk)
+                self.set_idxs(self_ijk, data_to_insert+addition)
 
-                elif combine=='replace':
-                    self.set_idxs(valid_ij, data_to_insert)
+            elif combine=='replace':
+                self.set_idxs(self_ijk, data_to_insert)
 
-                else:
-                    raise Exception("unknown combine type")
+            else:
+                raise Exception("unknown combine type")
 
-            valid_ij = None # to prevent acciental use again
-            valid_ij_in_input = None # to prevent acciental use again
 
         else:
             raise Exception("Unknown transformation method")
@@ -625,11 +1140,22 @@ class WorldVoxels(Voxels):
         if not keep_obj:
             os.remove(savepath + '.obj')
 
-    def project_unobserved_voxels(self, im):
+    def project_unobserved_voxels(self, im, chunk_size=1000000):
         # project the nan voxels from grid into the image...
         to_project_idxs = np.where(self.V.flatten() != np.nanmax(self.V))[0]
-        nan_xyz = self.world_meshgrid()[to_project_idxs]
-        return im.cam.project_points(nan_xyz).astype(np.int32), to_project_idxs
+
+        # a chunk at a time, to avoid making the full world meshgrid
+        projected = np.empty((to_project_idxs.shape[0], 3), np.int32)
+        for start in range(0, to_project_idxs.shape[0], chunk_size):
+            chunk = slice(start, start + chunk_size)
+            # cast down from float64 rather than using the float32 affine
+            # transform, as the truncation to pixels below is sensitive to the
+            # last bit for voxels projecting exactly onto pixel boundaries
+            nan_xyz = self.linear_idx_to_world(
+                to_project_idxs[chunk], dtype=None).astype(np.float32)
+            projected[chunk] = im.cam.project_points(nan_xyz).astype(np.int32)
+
+        return projected, to_project_idxs
 
     def plot_slices(self, savepath):
         '''
@@ -657,6 +1183,8 @@ class UprightAccumulator(WorldVoxels):
     Is an upright accumulator as assumed all the z directions are pointing the same way
     '''
 
+    grid_names = ('V', 'sumV', 'countV', 'explicit_countV')
+
     def __init__(self, gridsize, keep_explicit_count=False):
         '''
         keep_explicit_count is an option, if true we keep an integer count
@@ -665,15 +1193,41 @@ class UprightAccumulator(WorldVoxels):
         it is pretty hard to find out how many predictions are made everywhere
         '''
         Voxels.__init__(self, gridsize, np.float32)
+        self.gridsize = tuple(gridsize)
         self.grid_centre_from_grid_origin = []
-        self.sumV = (copy.deepcopy(self.V)*0)
-        self.countV = (copy.deepcopy(self.V)*0)
+        self.sumV = np.zeros(gridsize, np.float32)
+        self.countV = np.zeros(gridsize, np.float32)
 
         if keep_explicit_count:
-            self.explicit_countV = (copy.deepcopy(self.V)*0)
+            self.explicit_countV = np.zeros(gridsize, np.float32)
 
         self.keep_explicit_count = keep_explicit_count
 
+    def _plain_grid(self, V):
+        '''
+        returns V as a plain (dense) WorldVoxels grid, with the transform of
+        self but none of the accumulator arrays
+        '''
+        grid = WorldVoxels()
+        grid.V = V
+        grid.vox_size = self.vox_size
+        grid.set_origin(np.array(self.origin), np.array(self.R))
+        return grid
+
+    def blank_copy(self, dtype=np.float32):
+        '''
+        returns an empty (dense) WorldVoxels grid with the same shape and
+        transform as self
+        '''
+        return self._plain_grid(np.zeros(self.gridsize, dtype))
+
+    def average_copy(self):
+        '''
+        returns a copy of the average grid, V, as a plain WorldVoxels grid.
+        compute_average must have been called first
+        '''
+        return self._plain_grid(self.V.copy())
+
     def add_voxlet(self, voxlet, accum_only_predict_true, weights=None):
         '''
         adds a single voxlet into the output grid
@@ -682,54 +1236,641 @@ class UprightAccumulator(WorldVoxels):
             if true, then only add in the 'occupied' and the narrow band from the
             prediction.
         '''
-        if accum_only_predict_true:
-
-            self_world_xyz = self.world_meshgrid()
-            self_idx = self.idx_meshgrid()
-
-            # 2) Warp into idx space of input_grid and
-            # 3) See which are valid idxs in input_grid
-            data_to_insert, valid, _ = voxlet.just_valid_world_to_idx(self_world_xyz)
+        if weights is not None:
+            weights = weights.reshape(1, -1)
+
+        self.add_voxlets(ShoeBoxBatch.from_shoebox(voxlet),
+            voxlet.V.reshape(1, -1), accum_only_predict_true, weights=weights)
+
+    def add_voxlets(self, voxlets, predictions, accum_only_predict_true=False,
+            weights=None):
+        '''
+        adds a batch of voxlets into the output grid.
+        Equivalent to calling add_voxlet for each voxlet in the ShoeBoxBatch
+        voxlets, with voxel values given by the rows of the N x num_voxels
+        array predictions (and weights, if given).
+        All the (output voxel, voxlet voxel) pairs are found at once, and
+        added into the grid with a single np.bincount for each of
+        sumV, countV and explicit_countV
+        '''
+        target, sum_values, count_values, explicit_count = \
+            self.get_voxlet_contributions(
+                voxlets, predictions, accum_only_predict_true, weights)
+
+        _scatter_add(self.sumV, target, sum_values)
+        _scatter_add(self.countV, target, count_values)
+
+        if explicit_count:
+            _scatter_add(self.explicit_countV, target)
+
+    def get_voxlet_ij_boxes(self, voxlets):
+        '''
+        finds the box of columns of this grid which each voxlet in the
+        ShoeBoxBatch voxlets could overlap. Returns N x 2 arrays of the
+        (inclusive) start and (exclusive) end ij idxs of each box
+        '''
+        world_corners = voxlets.footprint_corners()
+        accum_corners = np.dot(
+            (world_corners - self.origin) / self.vox_size, self.inv_R.T)
+
+        box_start = np.maximum(
+            np.floor(accum_corners.min(axis=1)[:, :2]).astype(int) - 1, 0)
+        box_end = np.minimum(
+            np.floor(accum_corners.max(axis=1)[:, :2]).astype(int) + 2,
+            self.gridsize[:2])
+        return box_start, box_end
+
+    def get_voxlet_contributions(self, voxlets, predictions,
+            accum_only_predict_true=False, weights=None):
+        '''
+        finds what add_voxlets would add into the grid, without adding it.
+        Returns:
+            target          - the linear idxs into V of each contribution
+            sum_values      - the value to add onto sumV at each target
+            count_values    - the value to add onto countV at each target,
+                              or None if this is always one
+            explicit_count  - true if explicit_countV should also be incremented
+        Targets may be repeated, in which case the contributions are summed
+        '''
+        shape = voxlets.gridsize
+        num_voxlets = len(voxlets)
+
+        # which voxlet slice each of the output grid slices falls in
+        world_k = np.arange(self.gridsize[2])
+        world_z_col = self.idx_to_world(np.vstack(
+            (0 * world_k, 0 * world_k, world_k)).T)
+        voxlet_k = voxlets.world_to_idx(world_z_col)[:, :, 2]
+        valid_k = np.logical_and(voxlet_k >= 0, voxlet_k < shape[2])
+
+        # the footprint of each voxlet on the ij plane of the output grid.
+        # Only output columns in this box can possibly fall inside the voxlet
+        box_start, box_end = self.get_voxlet_ij_boxes(voxlets)
+        box_size = np.maximum((box_end - box_start).max(axis=0), 0)
+
+        box_i, box_j = np.meshgrid(
+            np.arange(box_size[0]), np.arange(box_size[1]), indexing='ij')
+        accum_i = box_start[:, 0:1] + box_i.ravel()[np.newaxis, :]
+        accum_j = box_start[:, 1:2] + box_j.ravel()[np.newaxis, :]
+        in_box = np.logical_and(accum_i < box_end[:, 0:1],
+                                accum_j < box_end[:, 1:2])
+
+        # now see which of these columns are inside each voxlet
+        accum_ij = np.stack(
+            (accum_i, accum_j, np.zeros_like(accum_i)), axis=2).reshape(-1, 3)
+        world_xy = self.idx_to_world(accum_ij).reshape(num_voxlets, -1, 3)
+        voxlet_ij = voxlets.world_to_idx(world_xy)
+
+        valid_ij = np.logical_and.reduce((
+            in_box,
+            voxlet_ij[:, :, 0] >= 0, voxlet_ij[:, :, 0] < shape[0],
+            voxlet_ij[:, :, 1] >= 0, voxlet_ij[:, :, 1] < shape[1]))
+
+        # every valid (column, slice) pair of every voxlet
+        which, col, k = np.nonzero(
+            np.logical_and(valid_ij[:, :, np.newaxis], valid_k[:, np.newaxis, :]))
+
+        target = np.ravel_multi_index(
+            (accum_i[which, col], accum_j[which, col], k), self.gridsize)
+        source = np.ravel_multi_index(
+            (which, voxlet_ij[which, col, 0], voxlet_ij[which, col, 1],
+                voxlet_k[which, k]),
+            (num_voxlets,) + tuple(shape))
+
+        data_to_insert = predictions.reshape(-1)[source]
 
-            # now only use the values which pass the test...
-            valid_data = data_to_insert < np.nanmax(voxlet.V)
-            data_to_insert = data_to_insert[valid_data]
-            valid = np.where(valid)[0][valid_data]
-
-            # 4) Replace these values in self
-            # do this manually...
-            self.sumV[self_idx[valid, 0], self_idx[valid, 1], self_idx[valid, 2]] += data_to_insert
-            self.countV[self_idx[valid, 0], self_idx[valid, 1], self_idx[valid, 2]] += 1
+        if accum_only_predict_true:
+            # only use the values which pass the test...
+            valid_data = data_to_insert < np.nanmax(predictions, axis=1)[which]
+            return (target[valid_data],
+                data_to_insert[valid_data].astype(np.float32), None, False)
 
         elif weights is not None:
-            # # Doing the accumulation in a naive way here...
-            weights_grid = voxlet.blank_copy()
-            weights_grid.V = weights.reshape(weights_grid.V.shape)
-            self.fill_from_grid(voxlet, method='axis_aligned',
-                combine='accumulator', weights=weights_grid,
-                keep_explicit_count=self.keep_explicit_count)
+            data_to_insert = data_to_insert.astype(np.float32)
+            weights_to_insert = weights.reshape(-1)[source].astype(np.float32)
+            return (target, data_to_insert * weights_to_insert,
+                weights_to_insert, self.keep_explicit_count)
 
         else:
-            self.fill_from_grid(voxlet, method='axis_aligned', combine='accumulator')
+            return (target, data_to_insert.astype(np.float32), None, False)
 
     def compute_average(self, nan_value=0):
         '''
         computes a grid of the average values, stores in V
+        V is reused from one call to the next, so copy it to keep the
+        average from an earlier call
         '''
-        nan_locations = self.countV==0
-        temp_countV = copy.deepcopy(self.countV)
-        temp_countV[nan_locations] = 100  # to avoid div by zero error
-        self.V = self.sumV / temp_countV
-        self.V[nan_locations] = np.nan #nan_value
-        #self.V[np.isinf(self.V)] = np.nan
+        if not (isinstance(self.V, np.ndarray) and self.V.shape == self.gridsize
+                and self.V.dtype == np.float32 and self.V.flags.writeable):
+            self.V = np.empty(self.gridsize, np.float32)
 
-        # clear these grid for memory reasons
-        #self.sumV = None
-        #self.countV = None
+        has_count = self.countV != 0
+        self.V.fill(np.nan) #nan_value
+        np.divide(self.sumV, self.countV, out=self.V, where=has_count)
 
         # return myself
         return self
 
+    def free_accumulators(self):
+        '''
+        frees the memory of sumV and countV (and explicit_countV), e.g. once
+        the average has been computed and the counts are no longer needed.
+        No more voxlets can be added until reset is called
+        '''
+        self.sumV = None
+        self.countV = None
+        if self.keep_explicit_count:
+            self.explicit_countV = None
+
+    def reset(self):
+        '''
+        empties the accumulator so it can be used again, reusing the memory
+        of sumV and countV (and explicit_countV) unless they have been freed
+        '''
+        names = ['sumV', 'countV']
+        if self.keep_explicit_count:
+            names.append('explicit_countV')
+
+        for name in names:
+            if getattr(self, name, None) is None:
+                setattr(self, name, np.zeros(self.gridsize, np.float32))
+            else:
+                getattr(self, name).fill(0)
+
+    def get_counts(self):
+        '''
+        returns a grid of how many predictions have been made at each voxel.
+        This is explicit_countV if it is kept, and countV otherwise
+        '''
+        if self.keep_explicit_count:
+            return self.explicit_countV
+        else:
+            return self.countV
+
+
+class SparseUprightAccumulator(UprightAccumulator):
+    '''
+    An UprightAccumulator which only stores the parts of the grid which
+    voxlets have been added into.
+    The grid is split into cubic bricks of brick_size voxels a side. The sums
+    and counts for a brick are only allocated the first time a voxlet touches
+    it, and are stored as rows of the arrays sum_bricks, count_bricks and
+    explicit_count_bricks. brick_slots gives the row used by each brick, or
+    -1 if the brick has not been allocated.
+    There is no dense V until compute_average is called, so until then the
+    inherited methods which read V (get_idxs, get_indicated_voxels etc.)
+    raise an AttributeError saying so.
+    '''
+
+    def __init__(self, gridsize, keep_explicit_count=False, brick_size=8):
+        self.gridsize = tuple(gridsize)
+        self.brick_size = brick_size
+        self.grid_centre_from_grid_origin = []
+        self.keep_explicit_count = keep_explicit_count
+
+        bricks_shape = tuple(
+            int(np.ceil(float(size) / brick_size)) for size in gridsize)
+        self.brick_slots = -np.ones(bricks_shape, dtype=np.int32)
+        self.num_bricks = 0
+
+        brick_voxels = brick_size ** 3
+        self.sum_bricks = np.zeros((0, brick_voxels), np.float32)
+        self.count_bricks = np.zeros((0, brick_voxels), np.float32)
+        if keep_explicit_count:
+            self.explicit_count_bricks = np.zeros((0, brick_voxels), np.float32)
+
+    grid_names = ('V', 'brick_slots', 'sum_bricks', 'count_bricks',
+                  'explicit_count_bricks')
+
+    def __getattr__(self, name):
+        # only called when normal attribute lookup fails
+        if name == 'V':
+            raise AttributeError("SparseUprightAccumulator has no dense V "
+                                 "until compute_average is called")
+        raise AttributeError(name)
+
+    @property
+    def shape(self):
+        return self.gridsize
+
+    def _brick_locations(self, target, allocate):
+        '''
+        converts linear idxs into the grid into linear idxs into the brick
+        arrays. If allocate is true, bricks which don't exist yet are created,
+        otherwise idxs in these bricks are returned as -1
+        '''
+        i, j, k = np.unravel_index(target, self.gridsize)
+        b = self.brick_size
+        bricks = np.ravel_multi_index(
+            (i // b, j // b, k // b), self.brick_slots.shape)
+        offsets = np.ravel_multi_index((i % b, j % b, k % b), (b, b, b))
+
+        slots = self.brick_slots.ravel()
+        if allocate:
+            new_bricks = np.unique(bricks[slots[bricks] < 0])
+            if new_bricks.shape[0] > 0:
+                self._allocate_bricks(new_bricks)
+
+        these_slots = slots[bricks]
+        return np.where(
+            these_slots >= 0, these_slots * b ** 3 + offsets, -1)
+
+    def _allocate_bricks(self, new_bricks):
+        '''
+        gives each of the new bricks a row in the brick arrays,
+        growing the arrays by doubling when they are full
+        '''
+        needed = self.num_bricks + new_bricks.shape[0]
+        if needed > self.sum_bricks.shape[0]:
+            capacity = max(needed, 2 * self.sum_bricks.shape[0])
+            self.sum_bricks = self._grow(self.sum_bricks, capacity)
+            self.count_bricks = self._grow(self.count_bricks, capacity)
+            if self.keep_explicit_count:
+                self.explicit_count_bricks = \
+                    self._grow(self.explicit_count_bricks, capacity)
+
+        self.brick_slots.ravel()[new_bricks] = \
+            np.arange(self.num_bricks, needed)
+        self.num_bricks = needed
+
+    def free_accumulators(self):
+        '''
+        as UprightAccumulator.free_accumulators, freeing the brick arrays
+        '''
+        self.sum_bricks = None
+        self.count_bricks = None
+        if self.keep_explicit_count:
+            self.explicit_count_bricks = None
+
+    def reset(self):
+        '''
+        as UprightAccumulator.reset. The brick arrays keep their size, so
+        bricks can be allocated again without growing them
+        '''
+        self.brick_slots.fill(-1)
+        self.num_bricks = 0
+
+        names = ['sum_bricks', 'count_bricks']
+        if self.keep_explicit_count:
+            names.append('explicit_count_bricks')
+
+        for name in names:
+            if getattr(self, name) is None:
+                setattr(self, name,
+                        np.zeros((0, self.brick_size ** 3), np.float32))
+            else:
+                getattr(self, name).fill(0)
+
+    def _grow(self, bricks, capacity):
+        grown = np.zeros((capacity, bricks.shape[1]), bricks.dtype)
+        grown[:bricks.shape[0]] = bricks
+        return grown
+
+    def add_voxlets(self, voxlets, predictions, accum_only_predict_true=False,
+            weights=None):
+        '''
+        as UprightAccumulator.add_voxlets, allocating bricks as needed
+        '''
+        target, sum_values, count_values, explicit_count = \
+            self.get_voxlet_contributions(
+                voxlets, predictions, accum_only_predict_true, weights)
+
+        brick_target = self._brick_locations(target, allocate=True)
+
+        _scatter_add(self.sum_bricks, brick_target, sum_values)
+        _scatter_add(self.count_bricks, brick_target, count_values)
+
+        if explicit_count:
+            _scatter_add(self.explicit_count_bricks, brick_target)
+
+    def _to_dense(self, bricks, fill_value):
+        '''
+        returns a dense grid of the values in the brick array bricks
+        '''
+        dense = np.empty(self.gridsize, np.float32)
+        dense.fill(fill_value)
+
+        b = self.brick_size
+        for brick_ijk in np.array(np.nonzero(self.brick_slots >= 0)).T:
+            start = brick_ijk * b
+            end = np.minimum(start + b, self.gridsize)
+            size = end - start
+            brick = bricks[self.brick_slots[tuple(brick_ijk)]].reshape(b, b, b)
+            dense[start[0]:end[0], start[1]:end[1], start[2]:end[2]] = \
+                brick[:size[0], :size[1], :size[2]]
+
+        return dense
+
+    def compute_average(self, nan_value=0, sparse=False):
+        '''
+        computes the average values.
+        If sparse is false, a dense grid of the averages is stored in V, and
+        self is returned, as UprightAccumulator.compute_average.
+        If sparse is true, the averages are just computed for the allocated
+        bricks, and are returned as an array of the ijk position of each
+        brick (in units of bricks) and an array of the bricks of averages
+        '''
+        b = self.brick_size
+        sums = self.sum_bricks[:self.num_bricks]
+        counts = self.count_bricks[:self.num_bricks]
+
+        average_bricks = np.empty(sums.shape, np.float32)
+        average_bricks.fill(np.nan)
+        has_count = counts != 0
+        average_bricks[has_count] = sums[has_count] / counts[has_count]
+
+        if sparse:
+            brick_ijk = np.array(np.nonzero(self.brick_slots >= 0)).T
+            slots = self.brick_slots[self.brick_slots >= 0]
+            return brick_ijk, average_bricks[slots].reshape(-1, b, b, b)
+
+        self.V = self._to_dense(average_bricks, np.nan)
+        return self
+
+    def get_counts(self):
+        '''
+        returns a dense grid of how many predictions have been made at each
+        voxel, as UprightAccumulator.get_counts
+        '''
+        if self.keep_explicit_count:
+            return self._to_dense(self.explicit_count_bricks, 0)
+        else:
+            return self._to_dense(self.count_bricks, 0)
+
+
+class SparseTSDF(WorldVoxels):
+    '''
+    A read only TSDF which only stores the values in the narrow band around
+    the surface. Every other voxel is +mu, -mu or unobserved (nan), and these
+    are stored as two bitmaps, of which voxels are observed and which are
+    negative.
+    Values are looked up with get_idxs, so a SparseTSDF can be the input grid
+    of fill_from_grid (and of ShoeBoxBatch.fill_from_grid) and the ground
+    truth of Scene.evaluate_prediction. V gives the dense grid, but is built
+    each time it is used (e.g. once by mesh.from_volume).
+    '''
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def from_dense(cls, grid, mu):
+        '''
+        Builds a SparseTSDF from the WorldVoxels grid, whose values should be
+        truncated at +-mu. The band is every observed voxel whose value is
+        not exactly +-mu, so converting back with to_dense is lossless
+        '''
+        sparse = cls()
+        sparse.gridsize = tuple(grid.V.shape)
+        sparse.dtype = grid.V.dtype
+        sparse.mu = mu
+        sparse.vox_size = grid.vox_size
+        sparse.set_origin(np.array(grid.origin), np.array(grid.R))
+
+        values = grid.V.ravel()
+        observed = ~np.isnan(values)
+        mu_value = sparse.dtype.type(mu)
+        in_band = observed & (values != mu_value) & (values != -mu_value)
+
+        # int32 idxs take half the memory, and are enough for most grids
+        idx_type = np.int32 if values.shape[0] < 2 ** 31 else np.int64
+        sparse.band_idxs = np.flatnonzero(in_band).astype(idx_type)
+        sparse.band_values = values[in_band]
+        sparse.observed_bits = np.packbits(observed)
+        with np.errstate(invalid='ignore'):
+            sparse.negative_bits = np.packbits(values < 0)
+        return sparse
+
+    @property
+    def shape(self):
+        return self.gridsize
+
+    @property
+    def V(self):
+        return self.to_dense()
+
+    def blank_copy(self):
+        '''
+        returns an empty (dense) WorldVoxels grid with the same shape and
+        transform as self
+        '''
+        blank = WorldVoxels()
+        blank.V = np.zeros(self.gridsize, self.dtype)
+        blank.vox_size = self.vox_size
+        blank.set_origin(np.array(self.origin), np.array(self.R))
+        return blank
+
+    def band_fraction(self):
+        '''
+        The fraction of the voxels which are stored in the band
+        '''
+        return self.band_idxs.shape[0] / float(self.num_voxels())
+
+    def to_dense(self):
+        '''
+        returns the full grid of values, as the grid from_dense was given
+        '''
+        n = self.num_voxels()
+        negative = np.unpackbits(self.negative_bits)[:n].astype(bool)
+        observed = np.unpackbits(self.observed_bits)[:n].astype(bool)
+
+        dense = np.where(negative, -self.mu, self.mu).astype(self.dtype)
+        dense[~observed] = np.nan
+        dense[self.band_idxs] = self.band_values
+        return dense.reshape(self.gridsize)
+
+    def _get_bits(self, bits, linear_idxs):
+        # packbits puts the first voxel in the highest bit of each byte
+        return ((bits[linear_idxs >> 3] >> (7 - (linear_idxs & 7))) & 1) \
+            .astype(bool)
+
+    def get_linear_idxs(self, linear_idxs):
+        '''
+        returns the values at the (C order) linear idxs into the grid
+        '''
+        linear_idxs = np.asarray(linear_idxs, dtype=np.int64)
+        values = np.where(self._get_bits(self.negative_bits, linear_idxs),
+                          -self.mu, self.mu).astype(self.dtype)
+        values[~self._get_bits(self.observed_bits, linear_idxs)] = np.nan
+
+        if self.band_idxs.shape[0] > 0:
+            band_position = np.minimum(
+                np.searchsorted(self.band_idxs, linear_idxs),
+                self.band_idxs.shape[0] - 1)
+            in_band = self.band_idxs[band_position] == linear_idxs
+            values[in_band] = self.band_values[band_position[in_band]]
+
+        return values
+
+    def get_idxs(self, ijk, check_bounds=False):
+        '''
+        as Voxels.get_idxs
+        '''
+        assert ijk.shape[1] == 3
+        if check_bounds:
+            valid = self.find_valid_idx(ijk)
+            output = np.zeros(ijk.shape[0]) * np.nan
+            output[valid] = self.get_idxs(ijk[valid])
+            return output
+        else:
+            return self.get_linear_idxs(
+                np.ravel_multi_index(ijk.T, self.gridsize))
+
+    def get_indicated_voxels(self, binary_array):
+        return self.get_linear_idxs(np.flatnonzero(binary_array))
+
+    def set_idxs(self, ijk, values, check_bounds=False):
+        raise Exception("SparseTSDF is read only, use to_dense to edit it")
+
+    def set_indicated_voxels(self, binary_array, values):
+        raise Exception("SparseTSDF is read only, use to_dense to edit it")
+
+    def fill_from_grid(self, *args, **kwargs):
+        raise Exception("SparseTSDF is read only, it can only be an input grid")
+
+
+class GridPyramid(object):
+    '''
+    Coarse summaries of a WorldVoxels grid, so that whole blocks of voxels
+    can be accepted or rejected before the voxels themselves are looked at.
+    Level l summarises blocks of 2**l voxels a side (levels 1, 2 and 3 by
+    default, i.e. 2x, 4x and 8x downsampling). Blocks at the far edges of the
+    grid are smaller where its size is not a multiple of the block size.
+    The summaries of each level (the min and max of the values in each block,
+    ignoring nans, and whether the block has any nans) are computed the first
+    time they are used. The block geometry doesn't need the values at all.
+    '''
+
+    def __init__(self, grid, num_levels=3):
+        self.grid = grid
+        self.num_levels = num_levels
+        self.summaries = {}
+
+    def block_size(self, level):
+        return 2 ** level
+
+    def level_shape(self, level):
+        b = self.block_size(level)
+        return tuple(int(np.ceil(float(size) / b)) for size in self.grid.shape)
+
+    def _downsample(self, values, ufunc, pad_value):
+        '''
+        combines each 2x2x2 block of values with ufunc (e.g. np.fmin), one
+        axis at a time, by combining the even and odd slices. Axes of odd
+        length are first padded with pad_value, which should not change the
+        result (e.g. nan for np.fmin)
+        '''
+        for axis in range(3):
+            if values.shape[axis] % 2:
+                pad_shape = list(values.shape)
+                pad_shape[axis] = 1
+                values = np.concatenate(
+                    (values, np.full(pad_shape, pad_value, values.dtype)),
+                    axis=axis)
+            even = [slice(None)] * 3
+            odd = [slice(None)] * 3
+            even[axis] = slice(0, None, 2)
+            odd[axis] = slice(1, None, 2)
+            values = ufunc(values[tuple(even)], values[tuple(odd)])
+        return values
+
+    def summary(self, level):
+        '''
+        returns the arrays (mins, maxs, any_nan) for the blocks of the level.
+        The mins and maxs ignore nans, and are nan for blocks all of nans.
+        Each level is computed from the one below it
+        '''
+        if level not in self.summaries:
+            if level == 1:
+                # (float16 arithmetic is slow, and its mins and maxs are
+                # exact in float32)
+                finer_mins = finer_maxs = self.grid.V.astype(
+                    np.promote_types(self.grid.V.dtype, np.float32), copy=False)
+                finer_any_nan = np.isnan(finer_mins)
+            else:
+                finer_mins, finer_maxs, finer_any_nan = self.summary(level - 1)
+            mins = self._downsample(finer_mins, np.fmin, np.nan)
+            maxs = self._downsample(finer_maxs, np.fmax, np.nan)
+            any_nan = self._downsample(finer_any_nan, np.logical_or, False)
+            self.summaries[level] = (mins, maxs, any_nan)
+
+        return self.summaries[level]
+
+    def blocks_in_range(self, level, low, high):
+        '''
+        blocks which may have a (non nan) value between low and high, e.g.
+        low=-mu, high=mu finds the blocks near the surface of a tsdf. All
+        other blocks can be skipped when looking for these values
+        '''
+        mins, maxs, _ = self.summary(level)
+        # blocks all of nans are not in range
+        with np.errstate(invalid='ignore'):
+            return np.logical_and(maxs >= low, mins <= high)
+
+    def expand(self, level, block_values):
+        '''
+        returns a full resolution grid with the value of each voxel's block
+        '''
+        b = self.block_size(level)
+        nx, ny, nz = block_values.shape
+        # (broadcasting, then copying once, is quicker than np.repeat per axis)
+        block_values = np.broadcast_to(
+            block_values[:, None, :, None, :, None],
+            (nx, b, ny, b, nz, b)).reshape(nx * b, ny * b, nz * b)
+        return block_values[:self.grid.shape[0],
+                            :self.grid.shape[1],
+                            :self.grid.shape[2]]
+
+    def block_corners(self, level):
+        '''
+        returns the world positions of the 8 outer corners of each block of
+        the level, as an (num blocks x 8 x 3) array, with the blocks in C order
+        '''
+        b = self.block_size(level)
+        A, B, C = np.mgrid[0:self.level_shape(level)[0],
+                           0:self.level_shape(level)[1],
+                           0:self.level_shape(level)[2]]
+        block_start = np.vstack((A.flatten(), B.flatten(), C.flatten())).T * b
+        block_end = np.minimum(block_start + b, self.grid.shape)
+
+        corners = np.empty((block_start.shape[0], 8, 3))
+        for count, corner in enumerate(itertools.product([0, 1], repeat=3)):
+            corners[:, count, :] = np.where(
+                np.array(corner) == 1, block_end, block_start)
+
+        # moving from voxel centres to the outer edges of the voxels
+        corners_world = self.grid.idx_to_world(corners.reshape(-1, 3) - 0.5)
+        return corners_world.reshape(-1, 8, 3)
+
+    def frustum_blocks(self, level, project_points, image_shape):
+        '''
+        Which blocks of the level are wholly inside or wholly outside the
+        image, using just the corners of each block. project_points is a
+        function (e.g. im.cam.project_points) giving the u, v, depth
+        of nx3 points, and image_shape is the (height, width) of the image.
+        Voxels are inside the image if their rounded u, v is a pixel, as in
+        carving.VoxelAccumulator.project_voxels. A block which is in front of
+        the camera projects to within the convex hull of its corners, so if
+        all the corners are inside (or all off the same side of) the image,
+        so are all its voxels. Other blocks must be checked voxel by voxel.
+        Returns two boolean arrays of the level's shape, (inside, outside)
+        '''
+        corners = self.block_corners(level)
+        projected = project_points(corners.reshape(-1, 3)).reshape(-1, 8, 3)
+        u, v, depth = projected[:, :, 0], projected[:, :, 1], projected[:, :, 2]
+        height, width = image_shape
+
+        in_front = np.all(depth > 0, axis=1)
+        inside = np.logical_and.reduce((
+            in_front,
+            np.all(u >= -0.5, axis=1), np.all(u < width - 0.5, axis=1),
+            np.all(v >= -0.5, axis=1), np.all(v < height - 0.5, axis=1)))
+        outside = np.logical_and(in_front, np.logical_or.reduce((
+            np.all(u < -0.5, axis=1), np.all(u > width - 0.5, axis=1),
+            np.all(v < -0.5, axis=1), np.all(v > height - 0.5, axis=1))))
+
+        return (inside.reshape(self.level_shape(level)),
+                outside.reshape(self.level_shape(level)))
+
 
 class ShoeBox(WorldVoxels):
     '''
@@ -783,3 +1924,241 @@ class ShoeBox(WorldVoxels):
         new_origin = point - np.dot(R, self.p_from_grid_origin)
 
         self.set_origin(new_origin, R)
+
+
+class ShoeBoxBatch(object):
+    '''
+    class for a batch of N shoeboxes, all of the same shape and voxel size.
+    Equivalent to N ShoeBox objects set up with initialise_from_point_and_normal,
+    but the poses are computed for all N points at once and stored as arrays:
+        R       - N x 3 x 3 rotations
+        inv_R   - N x 3 x 3 inverse rotations
+        origin  - N x 3 grid origins
+    Voxel data is not stored here; methods which return voxel values return
+    an N x num_voxels array, one flattened shoebox per row.
+    '''
+
+    def __init__(self, gridsize, vox_size, p_from_grid_origin):
+        assert p_from_grid_origin.shape[0] == 3
+        self.gridsize = tuple(gridsize)
+        self.vox_size = vox_size
+        self.p_from_grid_origin = p_from_grid_origin
+
+    @classmethod
+    def from_voxlet_params(cls, points, normals, voxlet_params):
+        '''
+        Initialises a shoebox of the type described by voxlet_params (as given
+        in the yaml files) at each of the N points, facing each of the N normals
+        '''
+        points = np.array(points, dtype=float)
+
+        if voxlet_params['tall_voxlets']:
+            start_z = voxlet_params['tall_voxlet_height']
+            points[:, 2] = start_z
+            vox_centre = \
+                np.array(voxlet_params['shape'][:2]) * \
+                voxlet_params['size'] * \
+                np.array(voxlet_params['relative_centre'][:2])
+            vox_centre = np.append(vox_centre, start_z)
+        else:
+            vox_centre = \
+                np.array(voxlet_params['shape']) * \
+                voxlet_params['size'] * \
+                np.array(voxlet_params['relative_centre'])
+
+        batch = cls(voxlet_params['shape'], voxlet_params['size'], vox_centre)
+        batch.initialise_from_points_and_normals(
+            points, normals, np.array([0, 0, 1]))
+        return batch
+
+    @classmethod
+    def from_shoebox(cls, shoebox):
+        '''
+        returns a batch containing just the pose of a single ShoeBox
+        '''
+        batch = cls(shoebox.V.shape, shoebox.vox_size, shoebox.p_from_grid_origin)
+        batch.R = shoebox.R[np.newaxis]
+        batch.inv_R = shoebox.inv_R[np.newaxis]
+        batch.origin = shoebox.origin[np.newaxis]
+        return batch
+
+    def __len__(self):
+        return self.origin.shape[0]
+
+    def __getitem__(self, item):
+        '''returns a new batch of the shoeboxes selected by item'''
+        batch = ShoeBoxBatch(self.gridsize, self.vox_size, self.p_from_grid_origin)
+        batch.R = self.R[item]
+        batch.inv_R = self.inv_R[item]
+        batch.origin = self.origin[item]
+        return batch
+
+    def num_voxels(self):
+        return np.prod(self.gridsize)
+
+    def initialise_from_points_and_normals(self, points, normals, updir):
+        '''
+        vectorised version of ShoeBox.initialise_from_point_and_normal, where
+        points and normals are Nx3 arrays
+        '''
+        assert updir.shape[0] == 3
+        assert normals.shape[1] == 3
+        assert points.shape[1] == 3
+
+        # creating the rotation matrices
+        new_z = np.tile(updir, (points.shape[0], 1))
+        new_x = np.cross(updir, normals)
+        new_x /= np.linalg.norm(new_x, axis=1)[:, np.newaxis]
+        new_y = np.cross(updir, new_x)
+        new_y /= np.linalg.norm(new_y, axis=1)[:, np.newaxis]
+        R = np.stack((new_x, new_y, new_z), axis=2).astype(float)
+
+        dets = np.linalg.det(R)
+        bad_dets = np.abs(dets - 1) > 0.00001
+        if np.any(bad_dets):
+            first_bad = np.where(bad_dets)[0][0]
+            print "R is " + str(R[first_bad])
+            print updir, normals[first_bad], points[first_bad]
+            raise Exception("R has det %f" % dets[first_bad])
+
+        # computing the grid origins
+        # using: p = R * p_from_grid_origin + grid_origin
+        self.origin = points - np.dot(R, self.p_from_grid_origin)
+        self.R = R
+        self.inv_R = np.linalg.inv(R)
+
+    def idx_to_world(self, idx):
+        '''
+        converts an nx3 integer array of [i, j, k] coordinates to real-world
+        3D locations in each of the shoeboxes. Returns an N x n x 3 array
+        '''
+        assert(idx.shape[-1] == 3)
+        scaled_idx = (idx.astype(float) + 0.5) * self.vox_size
+        scaled_rotated_idx = np.matmul(scaled_idx, self.R.transpose(0, 2, 1))
+        return scaled_rotated_idx + self.origin[:, np.newaxis, :]
+
+    def world_to_idx(self, xyz, detect_out_of_range=False):
+        '''
+        converts world coordinates to ijk locations in each of the shoeboxes.
+        xyz is either an nx3 array of points to convert into every shoebox,
+        or an N x n x 3 array with different points for each shoebox.
+        Returns an N x n x 3 integer array (and an N x n validity array if
+        detect_out_of_range is true)
+        '''
+        assert(xyz.shape[-1] == 3)
+        scaled_translated_xyz = \
+            (xyz - self.origin[:, np.newaxis, :]) / self.vox_size
+        scaled_translated_rotated_xyz = np.matmul(
+            scaled_translated_xyz, self.inv_R.transpose(0, 2, 1))
+        idx = np.floor(scaled_translated_rotated_xyz).astype(np.int)
+
+        if detect_out_of_range:
+            valid = np.logical_and.reduce((
+                idx[:, :, 0] >= 0, idx[:, :, 0] < self.gridsize[0],
+                idx[:, :, 1] >= 0, idx[:, :, 1] < self.gridsize[1],
+                idx[:, :, 2] >= 0, idx[:, :, 2] < self.gridsize[2]))
+            return idx, valid
+        else:
+            return idx
+
+    def footprint_corners(self):
+        '''
+        returns an N x 4 x 3 array of the world positions of the four corners
+        of the base of each shoebox. As the shoeboxes are upright, the xy
+        coordinates of these give the oriented rectangle each one covers on
+        the floor.
+        '''
+        corners = np.array([[0, 0, 0], [self.gridsize[0], 0, 0],
+                            [0, self.gridsize[1], 0],
+                            [self.gridsize[0], self.gridsize[1], 0]]) * self.vox_size
+        return np.matmul(corners, self.R.transpose(0, 2, 1)) + \
+            self.origin[:, np.newaxis, :]
+
+    def footprint_in_grid(self, grid):
+        '''
+        finds the columns of grid which lie beneath each voxel of the base of
+        each shoebox. Returns an N x M x 2 array of the ij idxs of these
+        columns, and an N x M array which is true where these are inside grid
+        '''
+        base_shape = self.gridsize[:2]
+        base_ij = np.array(np.unravel_index(
+            np.arange(np.prod(base_shape)), base_shape)).T
+        base_idx = np.hstack((base_ij, np.zeros((base_ij.shape[0], 1), int)))
+
+        world_xyz = self.idx_to_world(base_idx).reshape(-1, 3)
+        grid_ij = grid.world_to_idx(world_xyz)[:, :2].reshape(len(self), -1, 2)
+
+        valid = np.logical_and.reduce((
+            grid_ij[:, :, 0] >= 0, grid_ij[:, :, 0] < grid.V.shape[0],
+            grid_ij[:, :, 1] >= 0, grid_ij[:, :, 1] < grid.V.shape[1]))
+        return grid_ij, valid
+
+    def slices_in_grid(self, grid):
+        '''
+        finds which of the k slices of the upright grid fall inside each
+        (upright) shoebox, as in UprightAccumulator.get_voxlet_contributions.
+        Returns an N x grid.shape[2] boolean array
+        '''
+        grid_k = np.arange(grid.shape[2])
+        world_z_col = grid.idx_to_world(
+            np.vstack((0 * grid_k, 0 * grid_k, grid_k)).T)
+        shoebox_k = self.world_to_idx(world_z_col)[:, :, 2]
+        return np.logical_and(shoebox_k >= 0, shoebox_k < self.gridsize[2])
+
+    def idx_meshgrid(self):
+        '''
+        returns the idx position of every voxel in a shoebox, in the same order
+        as WorldVoxels.idx_meshgrid
+        '''
+        return np.array(np.unravel_index(
+            np.arange(self.num_voxels()), self.gridsize)).T
+
+    def fill_from_grid(self, input_grid, outside_value=np.nan, chunk_size=50,
+            interpolation='nearest'):
+        '''
+        Equivalent to filling each shoebox from input_grid with the 'naive'
+        method of WorldVoxels.fill_from_grid. Voxels of the shoeboxes which
+        fall outside of input_grid are given outside_value.
+        interpolation can be 'nearest' or 'trilinear'.
+        Returns an N x num_voxels float32 array.
+        The shoeboxes are processed chunk_size at a time to limit memory use.
+        '''
+        if interpolation not in ['nearest', 'trilinear']:
+            raise Exception("Unknown interpolation %s" % interpolation)
+
+        output = np.empty((len(self), self.num_voxels()), np.float32)
+        output.fill(outside_value)
+
+        idx = self.idx_meshgrid()
+
+        # reused for each chunk, as the idxs into input_grid fit into int32
+        idx_buffer = np.empty((min(len(self), chunk_size) * idx.shape[0], 3),
+                              np.int32)
+
+        for start in range(0, len(self), chunk_size):
+            chunk = self[start:start + chunk_size]
+
+            world_xyz = chunk.idx_to_world(idx).reshape(-1, 3)
+            input_idx, valid = input_grid.world_to_idx(
+                world_xyz, True, out=idx_buffer[:world_xyz.shape[0]])
+
+            chunk_output = output[start:start + chunk_size].reshape(-1)
+            if interpolation == 'trilinear':
+                chunk_output[valid] = \
+                    input_grid.trilinear_interpolate(world_xyz[valid])
+            else:
+                chunk_output[valid] = input_grid.get_idxs(input_idx[valid])
+
+        return output
+
+    def get_shoebox(self, n, data_type=np.float32):
+        '''
+        returns a ShoeBox object positioned as shoebox n of this batch
+        '''
+        shoebox = ShoeBox(self.gridsize, data_type)
+        shoebox.set_p_from_grid_origin(self.p_from_grid_origin)
+        shoebox.set_voxel_size(self.vox_size)
+        shoebox.origin = self.origin[n]
+        shoebox.R = self.R[n]
+        shoebox.inv_R = self.inv_R[n]
+        return shoebox
@@ -12,12 +12,15 @@ import copy
 import voxel_data
 import random_forest_structured as srf
 import features
+import timing
 from skimage import measure
 from sklearn.neighbors import NearestNeighbors
+from scipy.spatial import cKDTree
 import mesh
 import sklearn.metrics
 import collections
 import random
+import multiprocessing
 import scipy.misc
 import matplotlib.pyplot as plt
 
@@ -128,39 +131,136 @@ class VoxletPredictor(object):
         '''
         self.voxlet_counter = np.zeros(self.training_Y.shape[0])
 
+    def _index_predictions(self, X):
+        '''
+        Returns an N x num_trees array of indices into the training set, one
+        row for each row of X
+        '''
+        if hasattr(self, 'ml_type') and self.ml_type == 'nn':
+            _, index_predictions = self.nn.kneighbors(X)
+            return np.array(index_predictions)
+        else:
+            index_predictions = self.forest.test(X, max_depth=self.max_depth).astype(int)
+            # checking - should be one prediction per tree
+            assert index_predictions.shape[1] == len(self.forest.trees)
+            return index_predictions
+
+    def _decode_training_voxlets(self, idxs, timer):
+        '''
+        Reforms the training voxlets at the indices idxs (of any shape) from
+        their PCA, decoding each distinct voxlet only once however many trees
+        and rows predict it. The number of decodes saved is counted in
+        timer as pca_decode_cache_hits.
+        Returns an array of shape idxs.shape + (num_voxels,)
+        '''
+        unique_idxs, inverse = np.unique(idxs.ravel(), return_inverse=True)
+        decoded = self.pca.inverse_transform(self.training_Y[unique_idxs])
+        timer.count('pca_decode_cache_hits',
+            inverse.shape[0] - unique_idxs.shape[0])
+        return decoded[inverse].reshape(idxs.shape + (-1,))
+
     def predict(self, X, how_to_choose='medioid',
             distance_measure='just_empty', visible_voxlet=None, sc=None,
             this_shoebox=None, weight_predictions=False,
-            weight_parameter=None):
+            weight_parameter=None, timer=None):
         '''
-        Returns a voxlet prediction for a single X
+        Returns a voxlet prediction for a single X.
+        If a timing.StageTimer is given, the time spent in each stage of the
+        prediction is added to it
         '''
+        if timer is None:
+            timer = timing.StageTimer()
+
         # each tree predicts which index in the test set to use...
         # rows = test data (X), cols = tree
         # print "Feature vector is shape ", X.shape
-        if hasattr(self, 'ml_type') and self.ml_type == 'nn':
-            _, index_predictions = self.nn.kneighbors(X)
-            index_predictions = np.array(index_predictions[0])
-        else:
-            index_predictions = self.forest.test(X, max_depth=self.max_depth).astype(int)[0]
-            # checking - should be one prediction per tree
-            assert len(index_predictions) == len(self.forest.trees)
-
+        with timer.stage('forest'):
+            index_predictions = self._index_predictions(X)[0]
         self._cached_predictions = index_predictions
 
+        # now reform the original test data for each tree prediction
+        with timer.stage('pca_decode'):
+            tree_predictions = \
+                self._decode_training_voxlets(index_predictions, timer)
+
+        pointwise_idxs = None
+        if how_to_choose == 'closest' and distance_measure == 'pointwise':
+            # here we shold be projecing the raw kinect points into the
+            # space of the voxlet proposals, and extracting the tsdf
+            # values at these points.
+            xyz = sc.im.get_world_xyz()
+            idxs_in_shoebox, valid = this_shoebox.world_to_idx(
+                xyz, detect_out_of_range=True)
+            pointwise_idxs = np.ravel_multi_index(
+                idxs_in_shoebox[valid].T, this_shoebox.V.shape)
+
+        with timer.stage('distance'):
+            return self._choose_prediction(
+                tree_predictions, index_predictions, how_to_choose,
+                distance_measure, visible_voxlet, pointwise_idxs,
+                weight_predictions, weight_parameter)
+
+    def predict_batch(self, X, how_to_choose='medioid',
+            distance_measure='just_empty', visible_voxlets=None,
+            pointwise_idxs=None, weight_predictions=False,
+            weight_parameter=None, timer=None):
+        '''
+        Returns a voxlet prediction for each row of X, using a single pass
+        through the forest and a single PCA inverse transform for all rows.
+        visible_voxlets and pointwise_idxs, where needed, should have one
+        entry for each row of X. pointwise_idxs are the linear indices into
+        each voxlet of the image points which fall inside it.
+        If a timing.StageTimer is given, the time spent in each stage of the
+        prediction is added to it.
+        Returns (predictions, weights, min_dists), each with one row per row of X
+        '''
+        if timer is None:
+            timer = timing.StageTimer()
+
+        with timer.stage('forest'):
+            index_predictions = self._index_predictions(X)
+        num_rows, num_trees = index_predictions.shape
+
+        with timer.stage('pca_decode'):
+            all_tree_predictions = \
+                self._decode_training_voxlets(index_predictions, timer)
+
+        predictions = []
+        weights = []
+        min_dists = np.zeros(num_rows) * np.nan
+
+        with timer.stage('distance'):
+            for row in range(num_rows):
+                prediction, weight = self._choose_prediction(
+                    all_tree_predictions[row], index_predictions[row],
+                    how_to_choose, distance_measure,
+                    None if visible_voxlets is None else visible_voxlets[row],
+                    None if pointwise_idxs is None else pointwise_idxs[row],
+                    weight_predictions, weight_parameter)
+                predictions.append(prediction.flatten())
+                weights.append(np.array(weight).flatten())
+
+                if how_to_choose == 'closest':
+                    min_dists[row] = self.min_dist
+
+        return np.vstack(predictions), np.vstack(weights), min_dists
+
+    def _choose_prediction(self, tree_predictions, index_predictions,
+            how_to_choose, distance_measure, visible_voxlet, pointwise_idxs,
+            weight_predictions, weight_parameter):
+        '''
+        Chooses the final prediction from the prediction made by each tree.
+        Returns (final_prediction, final_weights)
+        '''
         # a weighting to be applied to the final mask - defaults to one!
         weighting = 1
 
-        # now reform the original test data for each tree prediction
-        tree_predictions = \
-            self.pca.inverse_transform(self.training_Y[index_predictions])
-
         # three different ways to choose which of the tree predictions to use
         if how_to_choose == 'closest':
             # makes the prediction which is closest to the observed data...
 
-            X = X.flatten()
-            visible_voxlet = visible_voxlet.flatten()
+            if visible_voxlet is not None:
+                visible_voxlet = visible_voxlet.flatten()
 
             # now we must be careful - use the biggest of the overlaps
             # between the predicted and the visible
@@ -226,26 +326,11 @@ class VoxletPredictor(object):
                 self.dims_to_use_for_distance_cache = dims_to_use_for_distance
 
             elif distance_measure == 'pointwise':
-                # here we shold be projecing the raw kinect points into the
-                # space of the voxlet proposals, and extracting the tsdf
-                # values at these points. The mean, or robust mean,  of these
-                # (or similar) will give the distance
-                tic = time.time()
-                xyz = sc.im.get_world_xyz()
-                idxs_in_shoebox, valid = this_shoebox.world_to_idx(
-                    xyz, detect_out_of_range=True)
-                valid_idxs_in_shoebox = idxs_in_shoebox[valid]
-
-                distances = []
-                for tree_prediction in tree_predictions:
-                    this_shoebox.V = tree_prediction.reshape(
-                        this_shoebox.V.shape)
-                    vals = this_shoebox.get_idxs(valid_idxs_in_shoebox)
-                    distances.append(np.mean(np.abs(vals)))
-                distances = np.array(distances)
-                # print "\n", distances, "\n"
-                # print "Distances pointwise measure took %f seconds" % \
-                #     (time.time() - tic)
+                # the pointwise_idxs are the image points which fall inside
+                # the voxlet. The mean, or robust mean, of the tsdf values at
+                # these points (or similar) will give the distance
+                vals = tree_predictions[:, pointwise_idxs]
+                distances = np.mean(np.abs(vals), axis=1)
 
                 if weight_predictions:
                     if weight_parameter is None:
@@ -257,8 +342,8 @@ class VoxletPredictor(object):
             self._distances_cache = distances
 
             final_prediction = tree_predictions[to_use]
-            final_mask = self.masks_pca.inverse_transform(
-                self.training_masks[index_predictions[to_use]])
+            self.mask_pca_cache = self.training_masks[index_predictions[to_use]]
+            final_mask = self.masks_pca.inverse_transform(self.mask_pca_cache)
             final_weights = 1.0 - final_mask
 
 
@@ -266,8 +351,8 @@ class VoxletPredictor(object):
 
             to_use = self._medioid_idx(tree_predictions)
             final_prediction = tree_predictions[to_use].flatten()
-            final_mask = self.masks_pca.inverse_transform(
-                self.training_masks[index_predictions[to_use]])
+            self.mask_pca_cache = self.training_masks[index_predictions[to_use]]
+            final_mask = self.masks_pca.inverse_transform(self.mask_pca_cache)
             final_weights = 1.0 - final_mask
 
         elif how_to_choose == 'mean':
@@ -277,6 +362,9 @@ class VoxletPredictor(object):
             final_prediction = np.mean(tree_predictions, axis=0).flatten()
             final_mask = np.mean(mask_predictions, axis=0).flatten()
             final_weights = 1.0 - final_mask
+            # the pca is linear, so this is the pca of the mean mask
+            self.mask_pca_cache = \
+                np.mean(self.training_masks[index_predictions], axis=0)
 
         else:
             raise Exception('Unknown how_to_choose: ', how_to_choose)
@@ -324,6 +412,158 @@ class VoxletPredictor(object):
         return X.take(rand_exs, 0), Y.take(rand_exs, 0), masks.take(rand_exs, 0), scene_ids.take(rand_exs, 0)
 
 
+def reconstruct_tile_helper(tile_job):
+    '''
+    Parallel reconstruction helper - predicts the voxlets of the samples
+    given to a single tile, and adds them into an accumulator covering just
+    the columns (start to end) of the output grid which they overlap.
+    Returns the tile's grids, statistics, timer, number of samples added
+    and the models' voxlet counts
+    '''
+    start, end, samples = tile_job
+
+    # each tile gets its own accumulator, timer and voxlet counts
+    reconstructer.accum = _tile_accumulator(accum, start, end)
+    reconstructer.timer = timing.StageTimer()
+    for model in reconstructer.model:
+        if hasattr(model, 'voxlet_counter'):
+            model.voxlet_counter = np.zeros_like(model.voxlet_counter)
+
+    stats = reconstructer._empty_batch_stats(
+        len(reconstructer.sc.sampled_idxs))
+    count = reconstructer._add_samples(samples, stats, **batch_options)
+
+    tile_grids = (reconstructer.accum.sumV, reconstructer.accum.countV,
+        getattr(reconstructer.accum, 'explicit_countV', None))
+    voxlet_counters = [getattr(model, 'voxlet_counter', None)
+                       for model in reconstructer.model]
+    return (tile_grids, [stat[samples] for stat in stats],
+        reconstructer.timer, count, voxlet_counters)
+
+
+def _init_tile_worker(reconstructer_in, batch_options_in):
+    '''
+    Each pool process calls this initializer. Here we load the reconstructer
+    (with its scene and models), the geometry of its output grid and the
+    options of the batched loop into that process's global namespace
+    '''
+    global reconstructer, accum, batch_options
+    reconstructer = reconstructer_in
+    accum = reconstructer_in.accum.copy(grids=[])
+    batch_options = batch_options_in
+
+
+def _tile_accumulator(accum, start, end):
+    '''
+    returns an empty accumulator covering columns start to end of the
+    accumulator accum
+    '''
+    tile_shape = (end[0] - start[0], end[1] - start[1], accum.gridsize[2])
+    tile = voxel_data.UprightAccumulator(tile_shape, accum.keep_explicit_count)
+    tile_origin = accum.origin + accum.R.dot(
+        np.array([start[0], start[1], 0]) * accum.vox_size)
+    tile.set_origin(tile_origin, accum.R)
+    tile.set_voxel_size(accum.vox_size)
+    return tile
+
+
+class IncrementalEvaluator(object):
+    '''
+    Keeps running intersection and union counts between the prediction
+    currently in an accumulator and the ground truth of a scene, over the
+    same region as Scene.evaluate_prediction.
+    Candidate voxlets are scored by looking only at the voxels they overlap,
+    so the accumulator need not be copied or re-averaged for each candidate.
+    '''
+
+    def __init__(self, sc, accum):
+        if isinstance(accum, voxel_data.SparseUprightAccumulator):
+            raise Exception("Incremental evaluation needs a dense accumulator")
+
+        self.accum = accum
+        self.evaluate = sc.form_evaluation_region().ravel()
+        self.gt = np.logical_and(self.evaluate, sc.gt_tsdf.V.ravel() < 0)
+
+        self.prediction = self._occupied(
+            self.accum.sumV.ravel(), self.accum.countV.ravel())
+        self.intersection = np.logical_and(self.gt, self.prediction).sum()
+        self.union = np.logical_and(
+            self.evaluate, np.logical_or(self.gt, self.prediction)).sum()
+
+    def _occupied(self, sums, counts):
+        '''
+        which voxels would be predicted as occupied by compute_average
+        '''
+        has_count = counts != 0
+        occupied = np.zeros(sums.shape, dtype=bool)
+        occupied[has_count] = sums[has_count] / counts[has_count] < 0
+        return occupied
+
+    def _iou(self, intersection, union):
+        if union == 0:
+            return 0.0
+        return float(intersection) / float(union)
+
+    def iou(self):
+        '''the iou of the accumulator as it currently stands'''
+        return self._iou(self.intersection, self.union)
+
+    def propose_voxlet(self, voxlet, accum_only_predict_true, weights=None):
+        '''
+        Works out the effect of adding voxlet into the accumulator.
+        Returns the iou the accumulator would then have, and a proposal which
+        can be passed to accept_proposal to actually add the voxlet in.
+        '''
+        if weights is not None:
+            weights = weights.reshape(1, -1)
+
+        target, sum_values, count_values, explicit_count = \
+            self.accum.get_voxlet_contributions(
+                voxel_data.ShoeBoxBatch.from_shoebox(voxlet),
+                voxlet.V.reshape(1, -1), accum_only_predict_true, weights)
+
+        # the new sums and counts at each voxel in the voxlet's footprint
+        footprint, inverse = np.unique(target, return_inverse=True)
+        new_sums = (self.accum.sumV.ravel()[footprint] +
+            np.bincount(inverse, weights=sum_values)).astype(self.accum.V.dtype)
+        new_counts = (self.accum.countV.ravel()[footprint] +
+            np.bincount(inverse, weights=count_values)).astype(self.accum.V.dtype)
+        new_prediction = self._occupied(new_sums, new_counts)
+
+        # change in intersection and union, just over the footprint
+        old_prediction = self.prediction[footprint]
+        gt = self.gt[footprint]
+        evaluate = self.evaluate[footprint]
+
+        intersection = self.intersection + \
+            np.logical_and(gt, new_prediction).sum() - \
+            np.logical_and(gt, old_prediction).sum()
+        union = self.union + \
+            np.logical_and(evaluate, np.logical_or(gt, new_prediction)).sum() - \
+            np.logical_and(evaluate, np.logical_or(gt, old_prediction)).sum()
+
+        proposal = dict(footprint=footprint, inverse=inverse,
+            sums=new_sums, counts=new_counts, prediction=new_prediction,
+            explicit_count=explicit_count,
+            intersection=intersection, union=union)
+
+        return self._iou(intersection, union), proposal
+
+    def accept_proposal(self, proposal):
+        '''adds the voxlet from propose_voxlet into the accumulator'''
+        footprint = proposal['footprint']
+
+        self.accum.sumV.ravel()[footprint] = proposal['sums']
+        self.accum.countV.ravel()[footprint] = proposal['counts']
+        if proposal['explicit_count']:
+            self.accum.explicit_countV.ravel()[footprint] += \
+                np.bincount(proposal['inverse'])
+
+        self.prediction[footprint] = proposal['prediction']
+        self.intersection = proposal['intersection']
+        self.union = proposal['union']
+
+
 class Reconstructer(object):
     '''
     Does the final prediction. Given a 'scene' (self.sc) and a predictor model
@@ -331,6 +571,19 @@ class Reconstructer(object):
     makes a voxlet prediction.
     These predictions are then fused into an output grid (self.accum).
     '''
+
+    # the oracles which need the ground truth voxlets
+    gt_oracles = ['gt', 'pca', 'nn', 'greedy_add', 'true_greedy_gt']
+
+    # what is stored about each of the possible predictions in true greedy.
+    # The footprint is the xy positions of the corners of the voxlet's base,
+    # i.e. its oriented rectangle on the floorplan
+    greedy_pose_dtype = np.dtype([
+        ('distance', np.float64),
+        ('model', np.int32),
+        ('idx', np.int32, 2),
+        ('footprint', np.float32, (4, 2))])
+
     def __init__(self):
         pass
 
@@ -346,48 +599,67 @@ class Reconstructer(object):
         position and rotation in world space
         '''
         assert(index.shape[0] == 2)
-        world_xyz = self.sc.im.get_world_xyz()
-        world_norms = self.sc.im.get_world_normals()
+        shoebox = self._initialise_voxlet_batch(
+            index[np.newaxis, :], voxlet_params).get_shoebox(0)
+        shoebox.V += self.sc.mu  # set the outside area to mu
 
-        # convert to linear idx
-        point_idx = index[0] * self.sc.im.mask.shape[1] + index[1]
+        return shoebox
 
-        shoebox = voxel_data.ShoeBox(voxlet_params['shape'], np.float32)
-        shoebox.V *= 0
-        shoebox.V += self.sc.mu  # set the outside area to mu
+    def _initialise_voxlet_batch(self, idxs, voxlet_params):
+        '''
+        given an Nx2 array of points in an image, creates a ShoeBoxBatch of
+        voxlets at the appropriate positions and rotations in world space
+        '''
+        assert(idxs.shape[1] == 2)
 
-        start_x = world_xyz[point_idx, 0]
-        start_y = world_xyz[point_idx, 1]
-
-        if voxlet_params['tall_voxlets']:
-            start_z = voxlet_params['tall_voxlet_height']
-            vox_centre = \
-                np.array(voxlet_params['shape'][:2]) * \
-                voxlet_params['size'] * \
-                np.array(voxlet_params['relative_centre'][:2])
-            vox_centre = np.append(vox_centre, start_z)
-            # print "cen is ", vox_centre
-        else:
-            vox_centre = \
-                np.array(voxlet_params['shape']) * \
-                voxlet_params['size'] * \
-                np.array(voxlet_params['relative_centre'])
-            # print "cen is ", vox_centre
-            start_z = world_xyz[point_idx, 2]
-
-        shoebox.set_p_from_grid_origin(vox_centre)  # m
-        shoebox.set_voxel_size(voxlet_params['size'])  # m
-        shoebox.initialise_from_point_and_normal(
-            np.array([start_x, start_y, start_z]),
-            world_norms[point_idx],
-            np.array([0, 0, 1]))
+        # convert to linear idx
+        point_idxs = idxs[:, 0] * self.sc.im.mask.shape[1] + idxs[:, 1]
 
-        return shoebox
+        return voxel_data.ShoeBoxBatch.from_voxlet_params(
+            self.sc.im.get_world_xyz()[point_idxs],
+            self.sc.im.get_world_normals()[point_idxs],
+            voxlet_params)
 
-    def initialise_output_grid(self, gt_grid=None, keep_explicit_count=False):
-        '''defaulting to initialising from the ground truth grid...'''
-        self.accum = voxel_data.UprightAccumulator(
-            gt_grid.V.shape, keep_explicit_count)
+    def _pointwise_idxs(self, voxlets, image_xyz, image_tree):
+        '''
+        For each voxlet in the ShoeBoxBatch voxlets, returns the linear indices
+        into the voxlet of the image points (image_xyz) which fall inside it.
+        Only the points within the bounding sphere of each voxlet are
+        transformed, using the kd-tree image_tree built over image_xyz
+        '''
+        extent = np.array(voxlets.gridsize) * voxlets.vox_size
+        centres = voxlets.origin + np.dot(voxlets.R, extent / 2.0)
+        radius = np.linalg.norm(extent) / 2.0 + voxlets.vox_size
+
+        all_idxs = []
+        for count, nearby in enumerate(image_tree.query_ball_point(centres, radius)):
+            nearby = np.sort(np.array(nearby, dtype=int))
+            idxs, valid = voxlets[count:count+1].world_to_idx(
+                image_xyz[nearby], detect_out_of_range=True)
+            all_idxs.append(
+                np.ravel_multi_index(idxs[0, valid[0]].T, voxlets.gridsize))
+
+        return all_idxs
+
+    def initialise_output_grid(self, gt_grid=None, keep_explicit_count=False,
+            sparse=False, brick_size=8):
+        '''
+        The output grid takes its shape, origin and voxel size from gt_grid.
+        This is usually the ground truth grid, but can be any grid covering the
+        volume to reconstruct. If gt_grid is None the geometry comes from the
+        scene's im_tsdf, so no ground truth is needed.
+        If sparse is true, the accumulator only allocates memory for the
+        bricks of brick_size^3 voxels which voxlets are added into.
+        '''
+        if gt_grid is None:
+            gt_grid = self.sc.im_tsdf
+
+        if sparse:
+            self.accum = voxel_data.SparseUprightAccumulator(
+                gt_grid.V.shape, keep_explicit_count, brick_size)
+        else:
+            self.accum = voxel_data.UprightAccumulator(
+                gt_grid.V.shape, keep_explicit_count)
         self.accum.set_origin(gt_grid.origin, gt_grid.R)
         self.accum.set_voxel_size(gt_grid.vox_size)
 
@@ -418,7 +690,21 @@ class Reconstructer(object):
             scene_grid_for_comparison='im_tsdf',
             weight_predictions=False,
             weight_parameter=None,
-            aggregation_stop_points=[10, 50, 100, 200, 500]
+            aggregation_stop_points=[10, 50, 100, 200, 500],
+            batched=False,
+            batch_size=50,
+            inference_only=False,
+            compute_stats=False,
+            checkpoint_savepath=None,
+            sample_priority=None,
+            max_voxlets=None,
+            time_budget_s=None,
+            progress_callback=None,
+            tiles=None,
+            num_workers=None,
+            interpolation='nearest',
+            free_accumulators=False,
+            return_timings=False
             ):
         '''
         Doing the final reconstruction
@@ -439,7 +725,105 @@ class Reconstructer(object):
         use_binary:
             converts tsdf to binary before prediction and marging.
             MUST use only with a forest trained on binary predictions...
+
+        batched:
+            if true, the voxlet poses, features, forest predictions and
+            accumulation are computed for batch_size samples at a time,
+            instead of one sample at a time. The models are chosen for all
+            the samples up front, so with more than one model the random
+            choices (and so the reconstruction) differ from the unbatched
+            loop. Can not be used with the greedy oracles.
+
+        inference_only:
+            if true, the ground truth grid is never used, so the scene doesn't
+            need a gt_tsdf (see Scene.load_sequence's load_gt). Can't be used
+            with the oracles which need the ground truth, or with
+            scene_grid_for_comparison='gt_tsdf'.
+
+        compute_stats:
+            if true, diagnostic statistics are stored for each prediction:
+            the fraction of empty voxels in empty_voxels_in_voxlet_count and,
+            if not inference_only, the distance from the ground truth voxlet
+            in gt_minus_predictions.
+
+        checkpoint_savepath:
+            used by the true greedy oracles. If given, the average grid at each
+            of the aggregation_stop_points is saved (as float16) to
+            checkpoint_savepath % count instead of being kept in memory.
+
+        sample_priority, max_voxlets, time_budget_s, progress_callback:
+            options for anytime reconstruction, which need batched to be true.
+            The samples are processed in the order given by sample_priority:
+            None keeps the sampled order, 'unobserved' puts first the samples
+            whose voxlets cover the most unobserved space (scored once, up
+            front, see _unobserved_priorities).
+            At most max_voxlets samples are used, and no new batch is started
+            once time_budget_s seconds have passed, so the grid returned is the
+            best so far. progress_callback(count, average_grid) is called
+            once the number of voxlets added passes each of the
+            aggregation_stop_points.
+
+        tiles, num_workers:
+            if tiles is given (e.g. [2, 2]) the output grid is split into
+            tiles[0] x tiles[1] tiles in the xy plane, which are reconstructed
+            in parallel by num_workers processes (defaulting to one per tile,
+            up to the number of cores). Each sample goes to the tile under the
+            centre of its voxlet, which does its features, forest prediction
+            and accumulation, so each voxlet is still predicted just once.
+            The stage times in self.timer are then summed over the tiles.
+            Needs batched, and can't be used with progress_callback. With
+            time_budget_s, each tile stops when the budget is used up.
+
+        interpolation:
+            how the tsdf is sampled for the features, 'nearest' or
+            'trilinear'. Should be the same as was used in training.
+
+        free_accumulators:
+            if true, the sums and counts of the accumulator are freed once
+            the output grids have been made, leaving just the average grid.
+
+        If the scene's points were sampled with a model chosen for each (see
+        Scene.sample_points), those models are used rather than choosing
+        them here with the model probabilities.
+
+        The wall time of each stage of the reconstruction (features, forest,
+        pca_decode, distance, accumulate etc.) and counters such as the number
+        of voxlets accepted are kept in self.timer, a timing.StageTimer.
+        With tiles, the timers of the tile processes are merged into it, and
+        the wall time of the parallel part is the 'tiles' stage.
+        If return_timings is true, this timer is returned too, as
+        (result, timer).
         '''
+        start_time = time.time()
+        self.timer = timing.StageTimer()
+
+        if tiles is not None and (not batched or progress_callback is not None):
+            raise Exception("Tiled reconstruction needs batched, and can't "
+                            "have a progress callback")
+
+        anytime_options = [sample_priority, max_voxlets, time_budget_s,
+                           progress_callback]
+        if not batched and any(option is not None for option in anytime_options):
+            raise Exception("Anytime reconstruction options need batched")
+        if inference_only and oracle in self.gt_oracles:
+            raise Exception(
+                "Oracle %s needs the ground truth, so can not be used with "
+                "inference_only" % oracle)
+        if inference_only and scene_grid_for_comparison == 'gt_tsdf':
+            raise Exception("Can not compare to the gt_tsdf when "
+                            "inference_only")
+
+        # the models chosen for each sample when the points were sampled
+        self.sc_model_choices = getattr(self.sc, 'sampled_model_choices', None)
+        if self.sc_model_choices is not None:
+            self.sc_model_choices = np.array(self.sc_model_choices)
+            if np.any(self.sc_model_choices >= len(self.model)):
+                raise Exception("The points were sampled for more models "
+                                "than there are")
+
+        # the ground truth voxlets are only extracted if something needs them
+        use_gt_voxlets = oracle in self.gt_oracles or \
+            (compute_stats and not inference_only)
 
         if np.any(np.array(['cobweb' == m.feature for m in self.model])):
             # nasty magic numbers here...
@@ -450,7 +834,8 @@ class Reconstructer(object):
         if np.any(np.array(['samples' == m.feature for m in self.model])):
             # nasty magic numbers here...
             sampleengine = features.SampledFeatures(
-                num_rings=vox_num_rings, radius=vox_radius)
+                num_rings=vox_num_rings, radius=vox_radius,
+                interpolation=interpolation)
             sampleengine.set_scene(self.sc)
             self.sampleengine=sampleengine
 
@@ -462,57 +847,88 @@ class Reconstructer(object):
 
         self.all_pred_cache = []
 
-        # if oracle == 'true_greedy' or oracle == 'true_greedy_gt':
         self.possible_predictions = []
 
         self.empty_voxels_in_voxlet_count = []
         self.gt_minus_predictions = []
 
+        if batched:
+            self._fill_in_output_grid_batched(
+                oracle, accum_only_predict_true, feature_collapse_type,
+                feature_collapse_param, use_binary, how_to_choose,
+                distance_measure, samples_out_of_range_feature,
+                scene_grid_for_comparison, weight_predictions,
+                weight_parameter, batch_size, use_gt_voxlets, compute_stats,
+                sample_priority, max_voxlets, time_budget_s, start_time,
+                aggregation_stop_points, progress_callback, tiles, num_workers,
+                interpolation=interpolation)
+            with self.timer.stage('finalise'):
+                result = self._finalise_output_grid(
+                    add_ground_plane, use_binary, min_countV, free_accumulators)
+            self.timer.add_time('total', time.time() - start_time)
+            if return_timings:
+                return result, self.timer
+            return result
+
+        if oracle == 'greedy_add':
+            # keeps track of the iou as voxlets are added in
+            greedy_evaluator = IncrementalEvaluator(self.sc, self.accum)
+
+        if oracle == 'true_greedy' or oracle == 'true_greedy_gt':
+            possible_poses = []
+            possible_voxlet_pcas = []
+            possible_mask_pcas = []
+
         "extract features from each shoebox..."
         for count, idx in enumerate(self.sc.sampled_idxs):
 
-            tic = time.time()
-
             if (count % 10) == 0:
                 sys.stdout.write('>> [%d]' % count)
                 sys.stdout.flush()
 
             # randomly choose model to use...
-            if len(self.model) == 1:
+            if self.sc_model_choices is not None:
+                model_to_use = self.model[self.sc_model_choices[count]]
+            elif len(self.model) == 1:
                 model_to_use = self.model[0]
             else:
                 model_to_use = np.random.choice(self.model, 1, p=self.model_probabilities)[0]
 
-            tic = time.time()
             this_idx_grid = getattr(self.sc, scene_grid_for_comparison)
 
             "extract features from the tsdf volume"
-            features_voxlet = self._initialise_voxlet(idx, model_to_use.voxlet_params)
-            features_voxlet.fill_from_grid(this_idx_grid)
-            features_voxlet.V[np.isnan(features_voxlet.V)] = -self.sc.mu
-            self.cached_feature_voxlet = features_voxlet.V
-
-            if use_binary:
-                features_voxlet.V = (features_voxlet.V > 0).astype(np.float16)
-
-            if model_to_use.feature=='cobweb':
-                feature_vector = cobwebengine.get_cobweb(idx)
-                feature_vector[np.isnan(feature_vector)] = -5.0
-                # print feature_vector
-            elif model_to_use.feature == 'idxs':
-                # use the xy location in the image as a feature, for debugging
-                feature_vector = np.array(idx)
-            elif model_to_use.feature=='samples':
-                feature_vector = sampleengine.sample_idx(idx)
-                feature_vector[np.isnan(feature_vector)] = \
-                    samples_out_of_range_feature
-            else:
-                feature_vector = self._feature_collapse(features_voxlet.V.flatten(),
-                    feature_collapse_type, feature_collapse_param)
+            with self.timer.stage('features'):
+                features_voxlet = self._initialise_voxlet(idx, model_to_use.voxlet_params)
+                features_voxlet.fill_from_grid(
+                    this_idx_grid, interpolation=interpolation)
+                features_voxlet.V[np.isnan(features_voxlet.V)] = -self.sc.mu
+                self.cached_feature_voxlet = features_voxlet.V
+
+                if use_binary:
+                    features_voxlet.V = (features_voxlet.V > 0).astype(np.float16)
+
+                if model_to_use.feature=='cobweb':
+                    feature_vector = cobwebengine.get_cobweb(idx)
+                    self.timer.count('nan_features', np.isnan(feature_vector).sum())
+                    feature_vector[np.isnan(feature_vector)] = -5.0
+                    # print feature_vector
+                elif model_to_use.feature == 'idxs':
+                    # use the xy location in the image as a feature, for debugging
+                    feature_vector = np.array(idx)
+                elif model_to_use.feature=='samples':
+                    feature_vector = sampleengine.sample_idx(idx)
+                    self.timer.count('nan_features', np.isnan(feature_vector).sum())
+                    feature_vector[np.isnan(feature_vector)] = \
+                        samples_out_of_range_feature
+                else:
+                    feature_vector = self._feature_collapse(features_voxlet.V.flatten(),
+                        feature_collapse_type, feature_collapse_param)
 
-            # getting the GT voxlet - useful for the oracles and rendering
-            gt_voxlet = self._initialise_voxlet(idx, model_to_use.voxlet_params)
-            gt_voxlet.fill_from_grid(self.sc.gt_tsdf, method='axis_aligned')
+            # getting the GT voxlet - useful for the oracles and statistics
+            if use_gt_voxlets:
+                with self.timer.stage('gt_voxlets'):
+                    gt_voxlet = self._initialise_voxlet(idx, model_to_use.voxlet_params)
+                    gt_voxlet.fill_from_grid(self.sc.gt_tsdf, method='axis_aligned')
 
             "Replace the prediction - if an oracle has been specified!"
             if oracle == 'gt':
@@ -545,14 +961,18 @@ class Reconstructer(object):
                         sc=self.sc,
                         this_shoebox=features_voxlet,
                         weight_predictions=weight_predictions,
-                        weight_parameter=weight_parameter)
+                        weight_parameter=weight_parameter,
+                        timer=self.timer)
                 self.cached_voxlet_prediction = voxlet_prediction
+                self.timer.count('voxlets_predicted')
                 # self.all_pred_cache.append(voxlet_prediction)
 
-                self.empty_voxels_in_voxlet_count.append(
-                    (voxlet_prediction > 0).sum().astype(float) / float(voxlet_prediction.size))
-                self.gt_minus_predictions.append(
-                    np.linalg.norm(voxlet_prediction - gt_voxlet.V.flatten()))
+                if compute_stats:
+                    self.empty_voxels_in_voxlet_count.append(
+                        (voxlet_prediction > 0).sum().astype(float) / float(voxlet_prediction.size))
+                    if use_gt_voxlets:
+                        self.gt_minus_predictions.append(
+                            np.linalg.norm(voxlet_prediction - gt_voxlet.V.flatten()))
 
                 # flipping the mask direction here:
                 # weights_to_use = 1-mask
@@ -574,102 +994,139 @@ class Reconstructer(object):
             #     pickle.dump(weights_to_use, f)
 
             if oracle == 'greedy_add':
-                acc_copy = self.accum.copy()
-                acc_copy.add_voxlet(transformed_voxlet, accum_only_predict_true, weights=weights_to_use)
+                # only evaluating the voxels which this voxlet would change
+                with self.timer.stage('accumulate'):
+                    new_iou, proposal = greedy_evaluator.propose_voxlet(
+                        transformed_voxlet, accum_only_predict_true,
+                        weights=weights_to_use)
+                    old_iou = greedy_evaluator.iou()
 
                 # now compare the two scores...
-                new_iou = self.sc.evaluate_prediction(acc_copy.compute_average().V)['iou']
-                old_iou = self.sc.evaluate_prediction(self.accum.compute_average().V)['iou']
-
                 if new_iou > old_iou:
-                    self.accum = acc_copy
+                    with self.timer.stage('accumulate'):
+                        greedy_evaluator.accept_proposal(proposal)
+                    self.timer.count('voxlets_accepted')
                     print "Accepting! Increase of %f" % (new_iou - old_iou)
                 else:
                     print "Rejecting! Would have decresed by %f" % (old_iou - new_iou)
 
             elif oracle == 'true_greedy' or oracle == 'true_greedy_gt':
                 # store up all the predictions, wait until the end to add them in
-                Di = {}
                 # The distance used depends on if we are comparing to the ground truth or the observed data...
                 if oracle == 'true_greedy':
                     # compare to the observed data
-                    Di['distance'] = model_to_use.min_dist
+                    distance = model_to_use.min_dist
                 elif oracle == 'true_greedy_gt':
                     # compare to the ground truth
-                    Di['distance'] = np.linalg.norm(
-                        transformed_voxlet.V.flatten()[model_to_use.dims_to_use_for_distance_cache.flatten()] -
-                        gt_voxlet.V.flatten()[model_to_use.dims_to_use_for_distance_cache.flatten()])
-
-                # ok this is quite nasty - we are recompressing the voxlets in
-                # order to save memory
-                Di['voxlet_pca'] = model_to_use.pca.transform(transformed_voxlet.V.flatten())
-                Di['mask_pca'] = model_to_use.masks_pca.transform(mask.flatten())
-                blank_voxlet = copy.deepcopy(transformed_voxlet)
-                blank_voxlet.V = []
-                Di['empty_voxlet'] = blank_voxlet
-
-                # shouldn't cause a memory issue, as should just store a
-                # reference to the model
-                Di['model'] = model_to_use
-                # Di['weights'] = weights_to_use
-
-                # saving this voxlet's position on a floorplan
-                world_ij_grid = self.sc.gt_tsdf.world_xy_meshgrid()
-                _, valid = transformed_voxlet.world_to_idx(world_ij_grid, detect_out_of_range=True)
-                Di['floorplan'] = copy.copy(self.sc.gt_tsdf.V[:, :, 0]) * 0
-                Di['floorplan'][valid.reshape(Di['floorplan'].shape)] = 1
-
-                self.possible_predictions.append(Di)
+                    dims = model_to_use.dims_to_use_for_distance_cache.flatten()
+                    distance = np.linalg.norm(
+                        transformed_voxlet.V.flatten()[dims] - gt_voxlet.V.flatten()[dims])
+
+                # saving this voxlet's position on the floorplan, as an
+                # oriented rectangle
+                footprint = voxel_data.ShoeBoxBatch.from_shoebox(
+                    transformed_voxlet).footprint_corners()[0, :, :2]
+
+                # the voxlet itself is recreated from its sample idx later,
+                # so only its pose, its (recompressed) prediction and the pca
+                # of the mask the predictor chose are stored
+                possible_poses.append((distance,
+                    self.model.index(model_to_use), idx, footprint))
+                possible_voxlet_pcas.append(model_to_use.pca.transform(
+                    np.atleast_2d(transformed_voxlet.V.flatten())).astype(np.float32))
+                possible_mask_pcas.append(np.atleast_2d(
+                    model_to_use.mask_pca_cache).astype(np.float32))
+
             else:
                 # Standard method - adding voxlet in regardless
                 try:
-                    self.accum.add_voxlet(transformed_voxlet,
-                        accum_only_predict_true, weights=weights_to_use)
+                    with self.timer.stage('accumulate'):
+                        self.accum.add_voxlet(transformed_voxlet,
+                            accum_only_predict_true, weights=weights_to_use)
+                    self.timer.count('voxlets_accepted')
                 except:
                     import pdb; pdb.set_trace()
 
         if oracle == 'true_greedy' or oracle == 'true_greedy_gt':
             # in true greedy, then we wait until here to add everything together...
-            # sort so the smallest possible predictions are at the front...
-
-            # this is when to save the grid for visualisation purposes...
-            stop_points = aggregation_stop_points
-
-            results = collections.OrderedDict()
-            self.possible_predictions.sort(key=lambda x: x['distance'])
-
-            for count, prediction in enumerate(self.possible_predictions):
-
-                # add this one in...
-                vox_shape = model_to_use.voxlet_params['shape']
-
-                this_voxlet_V = prediction['model'].pca.inverse_transform(
-                    prediction['voxlet_pca']).reshape(vox_shape)
-                this_mask = prediction['model'].masks_pca.inverse_transform(
-                    prediction['mask_pca']).reshape(vox_shape)
-                this_weights = 1 - this_mask
-                prediction['empty_voxlet'].V = this_voxlet_V
-
-                self.accum.add_voxlet(prediction['empty_voxlet'],
-                    accum_only_predict_true, weights=this_weights)
-                # filled_fplan = np.logical_or(filled_fplan, prediction['floorplan'])
-
-                prediction['empty_voxlet'].V = []
-
-                if count in stop_points:
-                    results[count] = copy.deepcopy(self.accum.compute_average())
-                    # good for memory...
-                    results[count].sumV = []
-                    results[count].countV = []
-
-                    if hasattr(results[count], 'explicit_countV'):
-                        results[count].explicit_countV = []
-
-                elif count > np.array(stop_points).max():
-                    break
+            self.possible_predictions = np.array(
+                possible_poses, dtype=self.greedy_pose_dtype)
+
+            with self.timer.stage('accumulate'):
+                result = self._aggregate_greedy(
+                    np.vstack(possible_voxlet_pcas), np.vstack(possible_mask_pcas),
+                    accum_only_predict_true, aggregation_stop_points,
+                    checkpoint_savepath, batch_size)
+        else:
+            with self.timer.stage('finalise'):
+                result = self._finalise_output_grid(
+                    add_ground_plane, use_binary, min_countV, free_accumulators)
+
+        self.timer.add_time('total', time.time() - start_time)
+        if return_timings:
+            return result, self.timer
+        return result
+
+    def _aggregate_greedy(self, voxlet_pcas, mask_pcas,
+            accum_only_predict_true, stop_points, checkpoint_savepath,
+            batch_size):
+        '''
+        Adds the possible predictions of the true greedy oracles into the
+        accumulator, best (smallest distance) first. Each is weighted by one
+        minus the mask its predictor chose. The average grid is
+        checkpointed after adding in each of the first stop_points + 1
+        predictions. Returns an OrderedDict of these checkpoints (or of the
+        paths they were saved to).
+        '''
+        poses = self.possible_predictions
+
+        # sort so the smallest possible predictions are at the front...
+        order = np.argsort(poses['distance'], kind='mergesort')
+
+        results = collections.OrderedDict()
+        start = 0
+        for stop_point in sorted(stop_points):
+            if stop_point >= len(order):
+                break
+
+            # add in everything up to and including this one...
+            to_add = order[start:stop_point + 1]
+            start = stop_point + 1
+
+            for model_idx, model in enumerate(self.model):
+                this_model = to_add[poses['model'][to_add] == model_idx]
+
+                for batch_start in range(0, len(this_model), batch_size):
+                    batch = this_model[batch_start:batch_start + batch_size]
+                    voxlets = self._initialise_voxlet_batch(
+                        poses['idx'][batch], model.voxlet_params)
+                    predictions = model.pca.inverse_transform(voxlet_pcas[batch])
+                    weights = 1 - model.masks_pca.inverse_transform(
+                        mask_pcas[batch])
+                    self.accum.add_voxlets(voxlets, predictions,
+                        accum_only_predict_true, weights=weights)
+                    self.timer.count('voxlets_accepted', batch.shape[0])
+
+            # just keeping the average, at half precision, for memory reasons
+            checkpoint = voxel_data.WorldVoxels()
+            checkpoint.V = self.accum.compute_average().V.astype(np.float16)
+            checkpoint.set_origin(self.accum.origin, self.accum.R)
+            checkpoint.set_voxel_size(self.accum.vox_size)
+
+            if checkpoint_savepath is not None:
+                checkpoint.save(checkpoint_savepath % stop_point)
+                results[stop_point] = checkpoint_savepath % stop_point
+            else:
+                results[stop_point] = checkpoint
 
-            return results
+        return results
 
+    def _finalise_output_grid(self, add_ground_plane, use_binary, min_countV,
+            free_accumulators=False):
+        '''
+        Forms the final output grids from the accumulator, once all the
+        voxlets have been added in
+        '''
         average = self.accum.compute_average()
 
         # creating a final output which preserves the existing geometry
@@ -692,21 +1149,10 @@ class Reconstructer(object):
             average.V += 0.5
             self.keeping_existing.V += 0.5
 
-        # good for memory...
-        # if True:
-        #     average.sumV = []
-        #     average.countV = []
-        #
-        #     if hasattr(average, 'explicit_countV'):
-        #         average.explicit_countV = []
-
         if min_countV is not None:
             # replace all the 'unknown' areas with empty space.
             # this should help to remove the 'floating' and spurious predictions
-            if hasattr(average, 'explicit_countV'):
-                counter = average.explicit_countV
-            else:
-                counter = average.countV
+            counter = average.get_counts()
 
             print "Of the %d elements in sumV, %d are too small" % \
                 (counter.size, (counter < min_countV).sum())
@@ -716,13 +1162,404 @@ class Reconstructer(object):
         self.average = average
 
         # removing the excess from the grid...
-        self.remove_excess = average.copy()
-        self.remove_excess.sumV = []
-        self.remove_excess.countV = []
+        self.remove_excess = average.average_copy()
         self.remove_excess.V[self.sc.im_tsdf.V > 0] = self.sc.mu
         self.remove_excess.V[np.isnan(self.remove_excess.V)] = self.sc.mu
+
+        if free_accumulators:
+            self.accum.free_accumulators()
+
         return self.remove_excess
 
+    def _fill_in_output_grid_batched(self, oracle, accum_only_predict_true,
+            feature_collapse_type, feature_collapse_param, use_binary,
+            how_to_choose, distance_measure, samples_out_of_range_feature,
+            scene_grid_for_comparison, weight_predictions, weight_parameter,
+            batch_size, use_gt_voxlets, compute_stats, sample_priority,
+            max_voxlets, time_budget_s, start_time, aggregation_stop_points,
+            progress_callback, tiles=None, num_workers=None,
+            interpolation='nearest'):
+        '''
+        Batched version of the main loop of fill_in_output_grid.
+        The model to use at each sampled point is chosen up front, then the
+        samples are processed batch_size at a time, in order of priority:
+        poses, features, forest predictions and accumulation are each done
+        in one go for the samples of each model in the batch.
+        If tiles is given, the samples are instead split between tiles of
+        the output grid, which are done in parallel by _fill_tiles
+        '''
+        if oracle in ['greedy_add', 'true_greedy', 'true_greedy_gt']:
+            raise Exception("Oracle %s can not be used when batched" % oracle)
+
+        sampled_idxs = np.array(self.sc.sampled_idxs)
+        num_samples = sampled_idxs.shape[0]
+
+        # randomly choose model to use for each sample...
+        if self.sc_model_choices is not None:
+            # ...unless they were chosen when the points were sampled
+            model_choices = self.sc_model_choices
+        elif len(self.model) == 1:
+            model_choices = np.zeros(num_samples, dtype=int)
+        else:
+            model_choices = np.random.choice(
+                len(self.model), num_samples, p=self.model_probabilities)
+
+        this_idx_grid = getattr(self.sc, scene_grid_for_comparison)
+
+        use_pointwise = \
+            how_to_choose == 'closest' and distance_measure == 'pointwise'
+        image_xyz = image_tree = None
+        if use_pointwise and oracle is None:
+            image_xyz = self.sc.im.get_world_xyz()
+            image_xyz = image_xyz[np.all(np.isfinite(image_xyz), axis=1)]
+            image_tree = cKDTree(image_xyz)
+
+        # the order in which to process the samples
+        if sample_priority is None:
+            order = np.arange(num_samples)
+        elif sample_priority == 'unobserved':
+            priorities = self._unobserved_priorities(sampled_idxs, model_choices)
+            order = np.argsort(-priorities, kind='mergesort')
+        else:
+            raise Exception("Unknown sample priority %s" % sample_priority)
+
+        if max_voxlets is not None:
+            order = order[:max_voxlets]
+
+        # everything needed to predict and add in a batch of samples
+        batch_options = dict(
+            model_choices=model_choices, batch_size=batch_size,
+            time_budget_s=time_budget_s, start_time=start_time,
+            accum_only_predict_true=accum_only_predict_true,
+            compute_stats=compute_stats, use_gt_voxlets=use_gt_voxlets,
+            prediction_options=dict(
+                oracle=oracle, feature_collapse_type=feature_collapse_type,
+                feature_collapse_param=feature_collapse_param,
+                use_binary=use_binary, how_to_choose=how_to_choose,
+                distance_measure=distance_measure,
+                samples_out_of_range_feature=samples_out_of_range_feature,
+                this_idx_grid=this_idx_grid,
+                weight_predictions=weight_predictions,
+                weight_parameter=weight_parameter,
+                use_gt_voxlets=use_gt_voxlets, interpolation=interpolation,
+                use_pointwise=use_pointwise, image_xyz=image_xyz,
+                image_tree=image_tree))
+
+        # statistics are stored in the order of the samples
+        stats = self._empty_batch_stats(num_samples)
+
+        if tiles is None:
+            count = self._add_samples(order, stats,
+                stop_points=np.array(sorted(aggregation_stop_points)),
+                progress_callback=progress_callback, **batch_options)
+        else:
+            count = self._fill_tiles(tiles, num_workers, order, stats,
+                batch_options)
+
+        predicted, empty_voxels_in_voxlet_count, gt_minus_predictions = stats
+
+        self.num_voxlets_added = count
+        self.predicted_samples = np.where(predicted)[0]
+        self.timer.count('voxlets_predicted', self.predicted_samples.shape[0])
+
+        if compute_stats:
+            self.empty_voxels_in_voxlet_count = \
+                list(empty_voxels_in_voxlet_count[predicted])
+        if compute_stats and use_gt_voxlets:
+            self.gt_minus_predictions = list(gt_minus_predictions[predicted])
+
+    def _empty_batch_stats(self, num_samples):
+        '''
+        the per sample statistics of the batched loop: whether each sample
+        was predicted, the fraction of empty voxels in its prediction and the
+        distance of its prediction from the ground truth voxlet
+        '''
+        return (np.zeros(num_samples, dtype=bool), np.zeros(num_samples),
+                np.zeros(num_samples))
+
+    def _add_samples(self, samples, stats, model_choices, batch_size,
+            time_budget_s, start_time, accum_only_predict_true, compute_stats,
+            use_gt_voxlets, prediction_options, stop_points=np.array([]),
+            progress_callback=None):
+        '''
+        Predicts the voxlets at the samples (indices into the scene's sampled
+        points), batch_size samples at a time in the order given, and adds
+        them into self.accum. The per sample statistics are written into
+        stats (see _empty_batch_stats).
+        Returns the number of samples added before the time budget ran out
+        '''
+        sampled_idxs = np.array(self.sc.sampled_idxs)
+        predicted, empty_voxels_in_voxlet_count, gt_minus_predictions = stats
+
+        count = 0
+        for start in range(0, samples.shape[0], batch_size):
+
+            if time_budget_s is not None and \
+                    time.time() - start_time > time_budget_s:
+                print "Time budget used up after %d voxlets" % count
+                break
+
+            these_samples = samples[start:start + batch_size]
+
+            sys.stdout.write('>> [%d]' % count)
+            sys.stdout.flush()
+
+            for model_idx, model_to_use in enumerate(self.model):
+
+                batch = these_samples[model_choices[these_samples] == model_idx]
+                if batch.shape[0] == 0:
+                    continue
+
+                voxlets, predictions, weights, gt_voxlets, was_predicted = \
+                    self._predict_voxlet_batch(
+                        sampled_idxs[batch], model_to_use, **prediction_options)
+
+                if was_predicted:
+                    predicted[batch] = True
+                    if compute_stats:
+                        empty_voxels_in_voxlet_count[batch] = \
+                            (predictions > 0).sum(axis=1).astype(float) / \
+                            float(predictions.shape[1])
+                    if compute_stats and use_gt_voxlets:
+                        gt_minus_predictions[batch] = \
+                            np.linalg.norm(predictions - gt_voxlets, axis=1)
+
+                # adding all the voxlets into the result
+                with self.timer.stage('accumulate'):
+                    self.accum.add_voxlets(voxlets, predictions,
+                        accum_only_predict_true, weights=weights)
+                self.timer.count('voxlets_accepted', batch.shape[0])
+
+            # passing the grid so far to the callback at each stop point
+            previous_count = count
+            count += these_samples.shape[0]
+            if progress_callback is not None and np.any(np.logical_and(
+                    stop_points > previous_count, stop_points <= count)):
+                progress_callback(count, self.accum.compute_average())
+
+        return count
+
+    def _predict_voxlet_batch(self, idxs, model_to_use, oracle,
+            feature_collapse_type, feature_collapse_param, use_binary,
+            how_to_choose, distance_measure, samples_out_of_range_feature,
+            this_idx_grid, weight_predictions, weight_parameter,
+            use_gt_voxlets, interpolation, use_pointwise, image_xyz,
+            image_tree):
+        '''
+        Makes the voxlets for the Nx2 image points idxs with model_to_use,
+        and predicts their contents (or takes them from an oracle).
+        Returns (voxlets, predictions, weights, gt_voxlets, was_predicted),
+        where gt_voxlets is None unless use_gt_voxlets, and was_predicted is
+        false if an oracle was used
+        '''
+        with self.timer.stage('features'):
+            voxlets = self._initialise_voxlet_batch(
+                idxs, model_to_use.voxlet_params)
+
+            "extract features from the tsdf volume, only if needed"
+            if (how_to_choose == 'closest' and not use_pointwise) or \
+                    model_to_use.feature not in ['cobweb', 'idxs', 'samples']:
+                features_voxlets = voxlets.fill_from_grid(
+                    this_idx_grid, self.sc.mu, interpolation=interpolation)
+                features_voxlets[np.isnan(features_voxlets)] = -self.sc.mu
+
+                if use_binary:
+                    features_voxlets = (features_voxlets > 0).astype(np.float16)
+            else:
+                features_voxlets = None
+
+            if model_to_use.feature == 'cobweb':
+                X = np.vstack(
+                    [self.cobwebengine.get_cobweb(idx) for idx in idxs])
+                self.timer.count('nan_features', np.isnan(X).sum())
+                X[np.isnan(X)] = -5.0
+            elif model_to_use.feature == 'idxs':
+                # use the xy location in the image as a feature, for debugging
+                X = idxs
+            elif model_to_use.feature == 'samples':
+                X = self.sampleengine.sample_idxs(idxs)
+                self.timer.count('nan_features', np.isnan(X).sum())
+                X[np.isnan(X)] = samples_out_of_range_feature
+            else:
+                X = np.vstack([self._feature_collapse(
+                    features_voxlet, feature_collapse_type,
+                    feature_collapse_param)
+                    for features_voxlet in features_voxlets])
+
+        # getting the GT voxlets - useful for the oracles and statistics
+        gt_voxlets = None
+        if use_gt_voxlets:
+            with self.timer.stage('gt_voxlets'):
+                gt_voxlets = voxlets.fill_from_grid(self.sc.gt_tsdf, self.sc.mu)
+
+        "Replace the predictions - if an oracle has been specified!"
+        if oracle == 'gt':
+            predictions = gt_voxlets
+            weights = predictions * 0 + 1
+
+        elif oracle == 'pca':
+            temp = model_to_use.pca.transform(gt_voxlets)
+            predictions = model_to_use.pca.inverse_transform(temp)
+            weights = predictions * 0 + 1
+
+        elif oracle == 'nn':
+            # getting the closest match in the training data to the gt...
+            _, indices = model_to_use.nbrs.kneighbors(
+                model_to_use.pca.transform(gt_voxlets))
+            predictions = model_to_use.pca.inverse_transform(
+                model_to_use.training_Y[indices[:, 0], :])
+            masks = model_to_use.masks_pca.inverse_transform(
+                model_to_use.training_masks[indices[:, 0], :])
+            weights = 1 - masks
+
+        else:
+            # Doing a real prediction!
+            if use_pointwise:
+                with self.timer.stage('features'):
+                    pointwise_idxs = self._pointwise_idxs(
+                        voxlets, image_xyz, image_tree)
+            else:
+                pointwise_idxs = None
+
+            predictions, weights, _ = model_to_use.predict_batch(
+                np.atleast_2d(X),
+                how_to_choose=how_to_choose,
+                distance_measure=distance_measure,
+                visible_voxlets=features_voxlets,
+                pointwise_idxs=pointwise_idxs,
+                weight_predictions=weight_predictions,
+                weight_parameter=weight_parameter,
+                timer=self.timer)
+
+            weights[predictions > 0] *= 0.5
+            return voxlets, predictions, weights, gt_voxlets, True
+
+        return voxlets, predictions, weights, gt_voxlets, False
+
+    def _fill_tiles(self, tiles, num_workers, order, stats, batch_options):
+        '''
+        The parallel version of _add_samples, for the samples in order.
+        The output grid is split into tiles[0] x tiles[1] tiles in the ij
+        plane, and each sample is given to the tile under the centre of its
+        voxlet's footprint. Each tile is done in a separate process, which
+        predicts its samples (in the order given) and adds them into an
+        accumulator covering just the columns their voxlets overlap. These
+        are then added into self.accum, along with the statistics and timers
+        of the tiles. Returns the number of samples added.
+        '''
+        if isinstance(self.accum, voxel_data.SparseUprightAccumulator):
+            raise Exception("Tiled reconstruction needs a dense accumulator")
+
+        sampled_idxs = np.array(self.sc.sampled_idxs)
+        model_choices = batch_options['model_choices']
+
+        # the range of output grid columns each voxlet can touch
+        box_start = np.zeros((order.shape[0], 2), int)
+        box_end = np.zeros((order.shape[0], 2), int)
+        for model_idx, model in enumerate(self.model):
+            these = np.where(model_choices[order] == model_idx)[0]
+            if these.shape[0] == 0:
+                continue
+            voxlets = self._initialise_voxlet_batch(
+                sampled_idxs[order[these]], model.voxlet_params)
+            box_start[these], box_end[these] = \
+                self.accum.get_voxlet_ij_boxes(voxlets)
+
+        # which tile each sample goes to
+        grid_ij = np.array(self.accum.gridsize[:2])
+        tile_edges = [np.linspace(0, grid_ij[dim], tiles[dim] + 1).astype(int)
+                      for dim in [0, 1]]
+        centres = (box_start + box_end) / 2
+        tile_ij = [np.clip(np.searchsorted(tile_edges[dim], centres[:, dim],
+                                           side='right') - 1, 0, tiles[dim] - 1)
+                   for dim in [0, 1]]
+
+        tile_jobs = []
+        for i in range(tiles[0]):
+            for j in range(tiles[1]):
+                these = np.where(
+                    np.logical_and(tile_ij[0] == i, tile_ij[1] == j))[0]
+                if these.shape[0] == 0:
+                    continue
+
+                # the columns covered by the voxlets of this tile
+                start = np.minimum(box_start[these].min(axis=0), grid_ij - 1)
+                end = np.maximum(box_end[these].max(axis=0), start + 1)
+                tile_jobs.append((start, end, order[these]))
+
+        if num_workers is None:
+            num_workers = min(len(tile_jobs), multiprocessing.cpu_count())
+
+        with self.timer.stage('tiles'):
+            pool = multiprocessing.Pool(processes=max(num_workers, 1),
+                initializer=_init_tile_worker, initargs=(self, batch_options))
+            tile_results = pool.map(reconstruct_tile_helper, tile_jobs)
+            pool.close()
+            pool.join()
+
+        # adding the tiles together, and gathering their statistics
+        count = 0
+        for (start, end, samples), (tile_grids, tile_stats, tile_timer,
+                tile_count, voxlet_counters) in zip(tile_jobs, tile_results):
+            tile = (slice(start[0], end[0]), slice(start[1], end[1]))
+            tile_sums, tile_counts, tile_explicit_counts = tile_grids
+            self.accum.sumV[tile] += tile_sums
+            self.accum.countV[tile] += tile_counts
+            if self.accum.keep_explicit_count:
+                self.accum.explicit_countV[tile] += tile_explicit_counts
+
+            for stat, tile_stat in zip(stats, tile_stats):
+                stat[samples] = tile_stat
+            for model, voxlet_counter in zip(self.model, voxlet_counters):
+                if voxlet_counter is not None:
+                    model.voxlet_counter += voxlet_counter
+
+            self.timer.merge(tile_timer)
+            count += tile_count
+
+        return count
+
+    def _unobserved_priorities(self, sampled_idxs, model_choices):
+        '''
+        Scores each sample by how much unobserved space its voxlet covers:
+        the number of unobserved voxels of im_tsdf in the columns under the
+        base of the voxlet, between the bottom and top of the voxlet.
+        The scores are worked out once, before any voxlets are added, so
+        overlapping voxlets are not marked down for covering the same space.
+        '''
+        im_tsdf = self.sc.im_tsdf
+
+        # the number of unobserved voxels below each slice of each column,
+        # so the count in slices k0 to k1 is a difference of two of these
+        unobserved = np.isnan(im_tsdf.V)
+        below = np.zeros(unobserved.shape[:2] + (unobserved.shape[2] + 1,), int)
+        np.cumsum(unobserved, axis=2, out=below[:, :, 1:])
+
+        priorities = np.zeros(sampled_idxs.shape[0])
+
+        for model_idx, model in enumerate(self.model):
+            these = np.where(model_choices == model_idx)[0]
+            if these.shape[0] == 0:
+                continue
+
+            voxlets = self._initialise_voxlet_batch(
+                sampled_idxs[these], model.voxlet_params)
+            column_ij, valid = voxlets.footprint_in_grid(im_tsdf)
+
+            # the voxlets are upright, so each covers a single run of slices
+            in_voxlet = voxlets.slices_in_grid(im_tsdf)
+            k_start = in_voxlet.argmax(axis=1)
+            k_end = k_start + in_voxlet.sum(axis=1)
+
+            which, col = np.nonzero(valid)
+            ci, cj = column_ij[which, col, 0], column_ij[which, col, 1]
+            column_counts = np.zeros(valid.shape)
+            column_counts[which, col] = \
+                below[ci, cj, k_end[which]] - below[ci, cj, k_start[which]]
+            priorities[these] = column_counts.sum(axis=1)
+
+        return priorities
+
     def save_voxlet_counts(self, fpath):
         # for each model...
         for model_idx, model in enumerate(self.model):
@@ -796,8 +1633,14 @@ class Reconstructer(object):
         plt.hold('off')
         plt.axis('off')
 
+        # without a ground truth grid, the observed grid is shown instead
+        if self.sc.gt_tsdf is not None:
+            top_view_grid = self.sc.gt_tsdf
+        else:
+            top_view_grid = self.sc.im_tsdf
+
         plt.subplot(132)
-        top_view = np.nanmean(self.sc.gt_tsdf.V, axis=2)
+        top_view = np.nanmean(top_view_grid.V, axis=2)
         # np.nanmean(self.sc.im_tsdf.V, axis=2)
         plt.imshow(top_view, cmap=plt.get_cmap('Greys'))
         plt.axis('off')
@@ -814,7 +1657,7 @@ class Reconstructer(object):
             # convert to linear idx
             point_idx = index[0] * self.sc.im.mask.shape[1] + index[1]
 
-            temp = self.sc.gt_tsdf.world_to_idx(
+            temp = top_view_grid.world_to_idx(
                 world_xyz[point_idx, None])[0][:2]
             t_norm = world_norms[point_idx, :2]
             t_norm /= np.linalg.norm(t_norm)
@@ -848,7 +1691,7 @@ class Reconstructer(object):
         c3 = [cen[0], cen[1] - v_size[1]]
         c4 = [-cen[0], cen[1] - v_size[1]]
 
-        corners = np.array((c2, c1, c4, c3, c2)) / self.sc.gt_tsdf.vox_size
+        corners = np.array((c2, c1, c4, c3, c2)) / self.sc.im_tsdf.vox_size
         return corners[:, ::-1]
 
     def _plot_voxlet(self, point, normal):
@@ -39,10 +39,6 @@ else:
     train_data_to_use = paths.all_train_data
 
 
-def flatten_sbox(sbox):
-    return sbox.V.flatten()
-
-
 def fit_and_save_pca(np_array, savepath):
 
     if parameters['pca']['subsample_length'] < np_array.shape[0]:
@@ -68,20 +64,15 @@ def process_sequence(sequence, voxlet_params):
 
     print "--> Processing " + sequence['scene']
     sc = scene.Scene(parameters['mu'], voxlet_params)
-    sc.load_sequence(sequence, frame_nos=0, segment_with_gt=parameters['segment_with_gt'], voxel_normals='gt_tsdf')
+    sc.load_sequence(sequence, frame_nos=0, segment_with_gt=parameters['segment_with_gt'], voxel_normals='gt_tsdf', mmap_gt=True, gt_cache_dir=system_setup.gt_cache_dir)
 
     # sampling points and extracting voxlets at these locations
     idxs = sc.sample_points(
         parameters['pca']['number_points_from_each_image'],
         additional_mask=sc.gt_im_label != 0,
         nyu='nyu_cad' in parameters['training_data'])
-    gt_shoeboxes = [sc.extract_single_voxlet(
-        idx,
-        extract_from=parameters['extract_from'],
-        post_transform=flatten_sbox)
-        for idx in idxs]
-
-    return np.array(gt_shoeboxes)
+    return sc.extract_voxlets(idxs, extract_from=parameters['extract_from'],
+        interpolation=parameters['interpolation'])
 
 
 def extract_all_voxlets(voxlet_params_in):
@@ -26,18 +26,14 @@ else:
     raise Exception('Unknown training data')
 
 
-def sbox_flatten(sbox):
-    """Applied to the GT shoeboxes after extraction"""
-    return sbox.V.flatten()
-
-
 # where to log the failures
 logf = open('../../data/failure_log.txt', 'w')
 
 cobwebengine = features.CobwebEngine(parameters['cobweb_offset'],
     use_mask=parameters['cobweb_use_mask'])
 sampleengine = features.SampledFeatures(
-    parameters['vox_num_rings'], parameters['vox_radius'])
+    parameters['vox_num_rings'], parameters['vox_radius'],
+    parameters['interpolation'])
 
 def process_sequence(sequence, pca, mask_pca, voxlet_params):
 
@@ -46,17 +42,17 @@ def process_sequence(sequence, pca, mask_pca, voxlet_params):
     sc = scene.Scene(parameters['mu'], voxlet_params)
     sc.load_sequence(sequence, frame_nos=0,
         segment_with_gt=parameters['segment_with_gt'],
-        segment=parameters['segment_scene'])
+        segment=parameters['segment_scene'], mmap_gt=True,
+        gt_cache_dir=system_setup.gt_cache_dir)
 
     # sampling locations to get the voxlets from
     idxs = sc.sample_points(parameters['number_points_from_each_image'],
                       additional_mask=sc.gt_im_label != 0,
                       nyu='nyu_cad' in parameters['training_data'])
 
-    gt_shoeboxes = [sc.extract_single_voxlet(
-        idx, extract_from=parameters['extract_from'], post_transform=sbox_flatten)
-        for idx in idxs]
-    np_sboxes = np.vstack(gt_shoeboxes)
+    np_sboxes = sc.extract_voxlets(
+        idxs, extract_from=parameters['extract_from'],
+        interpolation=parameters['interpolation'])
 
     cobwebengine.set_image(sc.im)
     np_cobweb = np.array(cobwebengine.extract_patches(idxs))
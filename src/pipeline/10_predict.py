@@ -58,13 +58,25 @@ if __name__ == '__main__':
                 print "Skipping"
                 return
 
+            # in inference only mode the ground truth grid is never loaded
+            inference_only = \
+                params['reconstruction_params'].get('inference_only', False)
+            if inference_only and params.get('ground_truth', False):
+                raise Exception("ground_truth needs the ground truth grid, "
+                                "so can't be used with inference_only")
+
             print "-> Loading ", sequence['name']
             sc = scene.Scene(params['mu'], [])
             sc.load_sequence(
                 sequence, frame_nos=0, segment_with_gt=False,
-                segment=False, original_nyu=parameters['original_nyu'])
+                segment=False, original_nyu=parameters['original_nyu'],
+                mmap_gt=True, load_gt=not inference_only,
+                gt_cache_dir=system_setup.gt_cache_dir)
             sc.sample_points(params['number_samples'],
-                nyu='nyu_cad' in parameters['testing_data'])
+                nyu='nyu_cad' in parameters['testing_data'],
+                method=params['sampling_method'],
+                voxlet_params=[model.voxlet_params for model in models],
+                model_probabilities=params['model_probabilities'])
             sc.im._clear_cache()
 
             if 'ground_truth' in params and params['ground_truth']:
@@ -84,8 +96,14 @@ if __name__ == '__main__':
                 print "-> Setting up the reconstruction object"
                 rec = voxlets.Reconstructer()
                 rec.set_scene(sc)
-                rec.initialise_output_grid(gt_grid=sc.gt_tsdf,
-                    keep_explicit_count=params['reconstruction_params']['weight_predictions'])
+                # in inference only mode the output grid is shaped like im_tsdf
+                if inference_only:
+                    output_grid = None
+                else:
+                    output_grid = sc.gt_tsdf
+                rec.initialise_output_grid(gt_grid=output_grid,
+                    keep_explicit_count=params['reconstruction_params']['weight_predictions'],
+                    sparse=params['sparse_accumulator'])
                 rec.set_model_probabilities(params['model_probabilities'])
                 rec.set_model(models)
                 rec.mu = params['mu']
@@ -93,11 +111,22 @@ if __name__ == '__main__':
                 for model in rec.model:
                     model.reset_voxlet_counts()
                     model.set_max_depth(params['max_depth'])
+                # the true greedy checkpoints go in this scene's folder
+                reconstruction_params = dict(params['reconstruction_params'])
+                if reconstruction_params.get('checkpoint_savepath'):
+                    reconstruction_params['checkpoint_savepath'] = \
+                        fpath + params['name'] + '_' + \
+                        reconstruction_params['checkpoint_savepath']
+
                 print "-> Doing prediction, type ", params['name']
                 # parameters from the yaml file are passed as separate arguments to voxlets
-                pred_voxlets = rec.fill_in_output_grid(**params['reconstruction_params'])
+                pred_voxlets, timings = rec.fill_in_output_grid(
+                    return_timings=True, **reconstruction_params)
                 print "TOOK %f seconds" % (time() - tic)
 
+                print "-> Saving the stage timings"
+                timings.save(fpath + params['name'] + '_timings.json')
+
                 print "-> Saving the sampled_idxs to a file"
                 np.savetxt(fpath + 'sampled_idxs.csv', sc.sampled_idxs, delimiter=",")
 
@@ -128,7 +157,11 @@ if __name__ == '__main__':
         # print "WARNING - smallsequence" * 10
         # paths.test_data = paths.test_data
 
-        if system_setup.multicore:
+        # tiled reconstructions use all the cores for each scene in turn, so
+        # the scenes are not also done in parallel
+        tiled = params['reconstruction_params'].get('tiles') is not None
+
+        if system_setup.multicore and not tiled:
             # need to import this *after* the pool helper has been defined
             import multiprocessing
             pool = multiprocessing.Pool(system_setup.testing_cores)
@@ -13,9 +13,14 @@ if True:
     cores = 7
     testing_cores = 6
     multicore = 1
+    # a local folder for copies of the gt grids with their nans filled in,
+    # so they can be memory mapped (see voxel_data.filled_dat_file).
+    # None to fill the nans as each grid is loaded
+    gt_cache_dir = None
 else:
     small_sample = True
     max_sequences = 4
     cores = 8
     testing_cores = 8
     multicore = True
+    gt_cache_dir = None